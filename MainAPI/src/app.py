@@ -5,7 +5,7 @@ from fastapi import Depends, HTTPException, status
 from sqlalchemy import create_engine, text
 from util.util import *
 from util.modelparams import *
-from util.db import MySQLDatabase
+from util.resources import registry
 import bcrypt
 import uuid
 import re
@@ -14,7 +14,7 @@ from email.mime.text import MIMEText
 
 
 
-database = MySQLDatabase()
+database = registry.database
 
 configs = read_configs()
 
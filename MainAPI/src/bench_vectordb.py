@@ -0,0 +1,108 @@
+'''
+Benchmarks the vector backends on synthetic unit embeddings.
+
+Reports query latency and recall@k against exact brute force search for each corpus size, and
+for the numpy backend the bytes per vector scanned in memory and stored on disk for every
+quantization mode.
+Run from MainAPI/src:  python bench_vectordb.py --sizes 10000 100000 1000000 --quantization none float16 int8
+'''
+import argparse
+import tempfile
+import time
+import numpy as np
+from util.vectorstore import ChromaBackend, NumpyBackend, QUANTIZED_COLUMNS, normalize_rows
+
+
+def synthetic_vectors(count: int, dim: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return normalize_rows(rng.standard_normal((count, dim), dtype=np.float32))
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> list:
+    sims = queries @ vectors.T
+    return [set(row) for row in np.argsort(-sims, axis=1)[:, :k]]
+
+
+def load(backend, vectors: np.ndarray, batch_size: int) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(vectors), batch_size):
+        batch = vectors[i: i+batch_size]
+        ids = list(range(i, i + len(batch)))
+        backend.add(0, ids=ids, embeddings=batch.tolist() if isinstance(backend, ChromaBackend) else batch,
+                    documents=[f'excerpt {j}' for j in ids], docids=[j // 100 for j in ids])
+
+    return time.perf_counter() - start
+
+
+def run_queries(backend, queries: np.ndarray, k: int):
+    latencies, results = [], []
+    for q in queries:
+        start = time.perf_counter()
+        found = backend.query(0, [q.tolist()], k)[0]
+        latencies.append(time.perf_counter() - start)
+        results.append(set(int(e['id']) for e in found))
+
+    return np.array(latencies), results
+
+
+def memory_report(backend: NumpyBackend, size: int) -> str:
+    '''
+    Bytes per vector of the columns scanned on every query and of the whole index on disk.
+    '''
+    usage = backend.index(0).disk_usage()
+    scanned = sum(usage[name] for name in QUANTIZED_COLUMNS[backend.quantization])
+    return f'  scanned={scanned / size:7.1f}B/vec  disk={sum(usage.values()) / size:7.1f}B/vec'
+
+
+def report(name: str, size: int, load_time: float, latencies: np.ndarray, results: list, truth: list, k: int, extra=''):
+    recall = np.mean([len(r & t) / k for r, t in zip(results, truth)])
+    print(f'{name:>16} n={size:>8} load={load_time:8.1f}s  p50={np.percentile(latencies, 50)*1000:8.2f}ms  '
+          f'p95={np.percentile(latencies, 95)*1000:8.2f}ms  recall@{k}={recall:.3f}' + extra)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the chroma and numpy vector backends.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--backends', nargs='+', default=['chroma', 'numpy'])
+    parser.add_argument('--quantization', nargs='+', default=['none', 'float16', 'int8'])
+    parser.add_argument('--rescore-factor', type=int, nargs='+', default=[0, 4])
+    args = parser.parse_args()
+
+    queries = synthetic_vectors(args.queries, args.dim, seed=1)
+
+    for size in args.sizes:
+        vectors = synthetic_vectors(size, args.dim, seed=0)
+        truth = exact_top_k(vectors, queries, args.k)
+
+        configurations = []
+        for name in args.backends:
+            if name == 'chroma':
+                configurations.append(('chroma', None, None))
+                continue
+
+            for quantization in args.quantization:
+                factors = [0] if quantization == 'none' else args.rescore_factor
+                configurations += [(name, quantization, factor) for factor in factors]
+
+        for name, quantization, factor in configurations:
+            with tempfile.TemporaryDirectory() as path:
+                if name == 'chroma':
+                    import chromadb
+                    backend = ChromaBackend(chromadb.PersistentClient(path=path))
+                    label = name
+                else:
+                    backend = NumpyBackend(path, quantization=quantization, rescore_factor=factor)
+                    label = f'{name}-{quantization}' + (f'-r{factor}' if factor else '')
+
+                load_time = load(backend, vectors, args.batch_size)
+                latencies, results = run_queries(backend, queries, args.k)
+                extra = memory_report(backend, size) if name == 'numpy' else ''
+                report(label, size, load_time, latencies, results, truth, args.k, extra)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,14 @@ from util import *
 from util.auth import *
 from util.modelparams import *
 from util.db import *
+from util.metrics import metrics
+from util.resources import registry
+from util.tokens import get_encoding
+from util.executors import run_blocking, executors
+from util.gpt import close_client
+from util.docprocessing import shutdown_pdf_pool
+from util.jobs import fail_interrupted_jobs
+from starlette.concurrency import run_in_threadpool
 from app import *
 from sqlalchemy import text
 from jose import JWTError, jwt
@@ -31,7 +39,21 @@ app.add_middleware(
 app.include_router(documents.router)
 app.include_router(dialogue.router)
 
-database = MySQLDatabase()
+database = registry.database
+registry.register_warm_up('tiktoken', get_encoding)
+
+
+@app.on_event('startup')
+async def warm_up_resources():
+    await run_in_threadpool(registry.warm_up)
+    await run_in_threadpool(fail_interrupted_jobs)
+
+
+@app.on_event('shutdown')
+async def shutdown_executors():
+    executors.shutdown()
+    shutdown_pdf_pool()
+    await close_client()
 
 
 @app.get(
@@ -50,11 +72,12 @@ async def state_endpoint():
     tags=['healthcheck']
 )
 async def testdb():
-    db = database.db
+    def show_tables():
+        with database.db.connect() as conn:
+            return conn.execute(text('SHOW tables;')).fetchall()
+
     try:
-        with db.connect() as conn:
-            res = conn.execute(text('SHOW tables;'))
-            tables = res.fetchall()
+        tables = await run_blocking('sql', show_tables)
     
     except Exception as e:
         logging.error(f'Failed to fetch db info. error: {e}')
@@ -66,6 +89,28 @@ async def testdb():
     return {'alive': True, 'tables': tables}
 
 
+@app.get(
+    '/ready',
+    summary='readiness check, true once shared resources are loaded.',
+    tags=['healthcheck']
+)
+async def readiness(response: Response):
+    result = await run_in_threadpool(registry.readiness)
+    if not result['ready']:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return result
+
+
+@app.get(
+    '/metrics',
+    summary='gets server counters and timing metrics.',
+    tags=['healthcheck']
+)
+async def get_metrics():
+    return metrics.snapshot()
+
+
 @app.post(
     '/register',
     summary='endpoint for user to register to system',
@@ -75,7 +120,8 @@ async def testdb():
 async def register_new_user(username:str=Form(), email:str=Form(), password:str=Form()):
     logging.info('registration request')
     params = RegisterUser(username=username, email=email, password=password)
-    result, msg = register_user(params)
+    # bcrypt hashing is the slow part, it releases the GIL so a thread pool is enough
+    result, msg = await run_blocking('cpu', register_user, params)
       
 
     return {'result': result, 'message': msg}
@@ -89,14 +135,14 @@ async def reset_password(
     email: str=Form()
 ):
     email = email.strip().lower()
-    userinfo = get_user_from_email(email)
+    userinfo = await run_blocking('sql', get_user_from_email, email)
     if userinfo is None:
         return {'No user found.'}
     
     token = create_access_token({'sub': userinfo.username, 'grant': 'password reset'}, tok_life=15)
     url = 'http://localhost:3000/reset?reset_token='+token
 
-    sent = send_reset_email(email, url)
+    sent = await run_blocking('io', send_reset_email, email, url)
 
 
     return {'success': sent}
@@ -111,9 +157,9 @@ async def change_password(
     token: Annotated[str, Depends(oauth2_scheme)],
     newpw: str = Form()
 ):
-    result, msg = update_password(userinfo, newpw)
+    result, msg = await run_blocking('cpu', update_password, userinfo, newpw)
     if result:
-        invalidate_token(token)
+        await run_blocking('sql', invalidate_token, token)
     return {'updated': result, 'message': msg}
 
 
@@ -143,7 +189,7 @@ async def logout(token: Annotated[str, Depends(oauth2_scheme)]):
         logging.error('no token supplied.')
         return {'success': False, 'message': 'No token supplied.'}
     
-    status = invalidate_token(token)
+    status = await run_blocking('sql', invalidate_token, token)
     if not status:
         return {'success': False, 'message': 'Failed to invalidate token'}
     else:
@@ -156,7 +202,7 @@ async def logout(token: Annotated[str, Depends(oauth2_scheme)]):
         tags=['authentication']
           )
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> Token:
-    user = authenticate_user(form_data)
+    user = await run_blocking('cpu', authenticate_user, form_data)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -0,0 +1,172 @@
+'''
+Rebuilds the vector store from the excerpts in MySQL, e.g. after the vectordb directory was lost
+or the embedding model in config.json changed.
+
+Excerpts are read in excerpt_id order with keyset pagination, embedded by a pool of threads and
+loaded into each user's collection batch by batch. Progress is checkpointed after every batch so an
+interrupted run continues where it stopped when started again.
+Run from MainAPI/src:  python reindex.py --fresh
+'''
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from util.resources import registry
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+def fetch_batch(conn, last_id: int, batch_size: int, users=None) -> list:
+    '''
+    Fetches the next batch of excerpts after last_id, optionally only for some users.
+    '''
+    user_filter = ''
+    if users:
+        user_filter = f'AND documents.user_id IN ({", ".join(str(int(u)) for u in users)}) '
+
+    query = text(
+        'SELECT excerpts.excerpt_id, excerpts.excerpt, excerpts.excerpt_hash, excerpts.doc_id, documents.user_id '
+        'FROM excerpts JOIN documents ON excerpts.doc_id=documents.doc_id '
+        f'WHERE excerpts.excerpt_id > :last_id {user_filter}'
+        'ORDER BY excerpts.excerpt_id ASC LIMIT :batch_size;'
+        )
+    data = conn.execute(query, dict(last_id=last_id, batch_size=batch_size))
+    return [dict(row) for row in data.mappings().fetchall()]
+
+
+def iter_batches(batch_size: int, last_id: int, users=None):
+    db = registry.database.db
+    while True:
+        with db.connect() as conn:
+            batch = fetch_batch(conn, last_id, batch_size, users)
+
+        if not batch:
+            return
+
+        last_id = batch[-1]['excerpt_id']
+        yield batch
+
+
+def get_user_ids(users=None) -> list:
+    if users:
+        return list(users)
+
+    with registry.database.db.connect() as conn:
+        data = conn.execute(text('SELECT DISTINCT user_id FROM documents;'))
+        return [row[0] for row in data.fetchall()]
+
+
+def load_checkpoint(path: str) -> dict:
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    # write then rename so an interrupted write never leaves a broken checkpoint
+    with open(path + '.tmp', 'w') as file:
+        json.dump(checkpoint, file, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+def load_batch(vectordb, batch: list, embeddings: list):
+    '''
+    Adds an embedded batch to the vector store with one add per user.
+    '''
+    by_user = {}
+    for row, embedding in zip(batch, embeddings):
+        excerpts, vectors = by_user.setdefault(row['user_id'], ([], []))
+        excerpts.append(row)
+        vectors.append(embedding)
+
+    for userid, (excerpts, vectors) in by_user.items():
+        vectordb.add_excerpts(userid, excerpts, vectors)
+
+
+def reindex(args):
+    vectordb = registry.vectordb
+    checkpoint = {} if args.restart else load_checkpoint(args.checkpoint)
+    target = {'model': vectordb.model, 'backend': vectordb.configs['database'].get('vector_backend', 'chroma'), 'users': args.users}
+
+    if checkpoint and {k: checkpoint.get(k) for k in target} != target:
+        raise SystemExit(f'Checkpoint {args.checkpoint} was made for {target} with different settings. Use --restart to start over.')
+
+    if not checkpoint:
+        if args.fresh:
+            for userid in get_user_ids(args.users):
+                vectordb.backend.drop(userid)
+            logging.info('dropped existing collections')
+
+        checkpoint = dict(target, last_excerpt_id=0, excerpts=0, seconds=0.0)
+        save_checkpoint(args.checkpoint, checkpoint)
+
+    else:
+        logging.info(f'resuming after excerpt {checkpoint["last_excerpt_id"]} ({checkpoint["excerpts"]} done)')
+
+    start, done_before = time.perf_counter(), checkpoint['excerpts']
+    seconds_before = checkpoint['seconds']
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        pending = deque()
+        batches = iter_batches(args.batch_size, checkpoint['last_excerpt_id'], args.users)
+
+        while True:
+            # keep every worker busy, then load finished batches in order so the checkpoint only moves forward
+            while len(pending) < args.workers:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append((batch, pool.submit(vectordb.embed_excerpts, batch)))
+
+            if not pending:
+                break
+
+            batch, future = pending.popleft()
+            load_batch(vectordb, batch, future.result())
+
+            elapsed = time.perf_counter() - start
+            checkpoint.update(
+                last_excerpt_id=batch[-1]['excerpt_id'],
+                excerpts=checkpoint['excerpts'] + len(batch),
+                seconds=seconds_before + elapsed
+                )
+            save_checkpoint(args.checkpoint, checkpoint)
+
+            rate = (checkpoint['excerpts'] - done_before) / max(elapsed, 1e-6)
+            logging.info(f'reindexed {checkpoint["excerpts"]} excerpts (up to id {checkpoint["last_excerpt_id"]}) at {rate:.1f} excerpts/s')
+
+    checkpoint['finished'] = True
+    save_checkpoint(args.checkpoint, checkpoint)
+
+    total_rate = checkpoint['excerpts'] / max(checkpoint['seconds'], 1e-6)
+    print(f'Reindexed {checkpoint["excerpts"]} excerpts in {checkpoint["seconds"]:.1f}s ({total_rate:.1f} excerpts/s)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the vector store from the excerpts in MySQL.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='excerpts per batch')
+    parser.add_argument('--workers', type=int, default=4, help='batches embedded in parallel')
+    parser.add_argument('--users', type=int, nargs='+', default=None, help='only reindex these user ids')
+    parser.add_argument('--checkpoint', default='reindex_checkpoint.json')
+    parser.add_argument('--fresh', action='store_true', help='drop the existing collections before loading')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+    args = parser.parse_args()
+
+    checkpoint = {} if args.restart else load_checkpoint(args.checkpoint)
+    if checkpoint.get('finished'):
+        print(f'Checkpoint {args.checkpoint} is from a finished run. Use --restart to reindex again.')
+        return
+
+    reindex(args)
+
+
+if __name__ == '__main__':
+    main()
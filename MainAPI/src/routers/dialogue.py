@@ -1,13 +1,19 @@
 from fastapi import APIRouter, FastAPI, HTTPException, Form, Depends
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
+from fastapi.responses import StreamingResponse
 import logging
+import json
 from util import *
 from util.modelparams import *
 from util.gpt import *
 from util.auth import *
-from util.db import VectorDB
-
-vectordb = VectorDB()
+from util.retrieval import query_excerpts, resolve_retrieval
+from util.executors import run_blocking
+from util.answers import answer_cache, cached_answer
+from util.cache import corpus_versions
+from util.context import build_context
+from util.singleflight import SingleFlight, SharedStream
+from util.util import normalize_query
 
 logging.basicConfig(level=logging.INFO)
 
@@ -20,25 +26,130 @@ router = APIRouter(
 )
 
 
+NO_EXCERPTS_MESSAGE = "I'm sorry, I could not find any information relating to your query."
+
+# identical questions in flight at the same time share one retrieval and one LLM call
+inflight_answers = SingleFlight('chat_answer')
+inflight_contexts = SingleFlight('chat_context')
+inflight_streams = SharedStream('chat_stream')
+
+
 @router.post(
         '/query',
         summary='Queries ChatGPT and gets response.'
 )
 async def prompt_gpt(
     userinfo: Annotated[UserInfo, Depends(get_current_user)],
-    query: str = Form()
+    query: str = Form(),
+    top_k: int = Form(default=None),
+    threshold: float = Form(default=None),
+    doc_ids: list[int] = Form(default=None),
+    stream: bool = Form(default=False)
 ):
-    excerpts = vectordb.query(query, userinfo.userid)
+    params = resolve_retrieval(top_k, threshold, doc_ids)
+    # read before retrieval so an answer racing with a document change is cached under the old version
+    version = corpus_versions.get(userinfo.userid)
+    key = (userinfo.userid, version, normalize_query(query), params.top_k, params.threshold, tuple(params.doc_ids or ()))
+
+    if not stream:
+        return await inflight_answers.run(key, lambda: answer_query(query, userinfo.userid, params, version))
+
+    prepared = await inflight_contexts.run(key, lambda: prepare_answer(query, userinfo.userid, params, version))
+    if not prepared['excerpts']:
+        return StreamingResponse(iter_events([('done', {'message': NO_EXCERPTS_MESSAGE})]), media_type='text/event-stream')
+
+    if prepared['cached'] is not None:
+        cached = prepared['cached']
+        events = [('excerpts', {'excerpts': prepared['excerpts']}), ('token', {'text': cached}), ('done', {'message': cached})]
+        return StreamingResponse(iter_events(events), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    return StreamingResponse(stream_answer(key, query, prepared), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+async def prepare_answer(query: str, userid: int, params: RetrievalParams, version: int) -> dict:
+    '''
+    Retrieves the excerpts for a query and either finds a cached answer or builds the LLM context.
+
+    Returns {'excerpts', 'cached'} plus {'passages', 'context', 'cache_key', 'embedding'} when
+    the LLM still has to be called.
+    '''
+    excerpts = await run_blocking('vector', query_excerpts, query, userid, params)
     if len(excerpts) == 0:
-        return {'message': "I'm sorry, I could not find any information relating to your query."}
+        return {'excerpts': [], 'cached': None}
+
+    cache_key = answer_cache.key(userid, version, excerpts)
+    cached, embedding = await run_blocking('vector', cached_answer, query, cache_key)
+    if cached is not None:
+        logging.info(f'answered query from cache for user: {userid}')
+        return {'excerpts': excerpts, 'cached': cached}
+
+    passages, context = await run_blocking('cpu', build_context, excerpts)
+    logging.info(f'prompt chatGPT request from user: {userid} ({context["tokens"]} context tokens, {context["tokens_saved"]} saved)')
+    return {
+        'excerpts': excerpts, 'cached': None, 'passages': passages,
+        'context': context, 'cache_key': cache_key, 'embedding': embedding
+        }
+
 
-    logging.info(f'prompt chatGPT request from user: {userinfo.userid}')
-    response = call_gpt(query, [e['text'] for e in excerpts])
+async def answer_query(query: str, userid: int, params: RetrievalParams, version: int) -> dict:
+    prepared = await prepare_answer(query, userid, params, version)
+    if not prepared['excerpts']:
+        return {'message': NO_EXCERPTS_MESSAGE}
+
+    if prepared['cached'] is not None:
+        return {'message': prepared['cached'], 'excerpts': prepared['excerpts']}
+
+    response = await call_gpt(query, prepared['passages'])
     
     if response:
         logging.info('Successfully queried chatGPT.')
+        answer_cache.set(prepared['cache_key'], prepared['embedding'], response)
     else:
         logging.info('Failed to query chatGPT.')
 
-    return {'message': response, 'excerpts': excerpts}
+    return {'message': response, 'excerpts': prepared['excerpts'], 'context': prepared['context']}
+
+
+def sse_event(event: str, data) -> str:
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+async def iter_events(events):
+    for event, data in events:
+        yield sse_event(event, data)
+
+
+async def generate_answer(query: str, prepared: dict):
+    '''
+    Streams the LLM response for a prepared query and adds the completed answer to the answer cache.
+    '''
+    pieces = []
+    async for piece in stream_gpt(query, prepared['passages']):
+        pieces.append(piece)
+        yield piece
+
+    logging.info('Successfully streamed chatGPT response.')
+    answer_cache.set(prepared['cache_key'], prepared['embedding'], ''.join(pieces))
+
+
+async def stream_answer(key: tuple, query: str, prepared: dict):
+    '''
+    Server sent events for a streamed answer: the excerpts first, a token event per piece of the
+    response as it arrives from the LLM, then done with the whole message (or error).
+    Identical queries streamed at the same time share one LLM call, a late caller first gets the
+    tokens already generated.
+    '''
+    yield sse_event('excerpts', {'excerpts': prepared['excerpts'], 'context': prepared['context']})
+
+    pieces = []
+    try:
+        async for piece in inflight_streams.subscribe(key, lambda: generate_answer(query, prepared)):
+            pieces.append(piece)
+            yield sse_event('token', {'text': piece})
+
+    except Exception as e:
+        logging.error(f'Failed to stream chatGPT response. Error: {e}')
+        yield sse_event('error', {'message': 'Failed to get a response.'})
+        return
 
+    yield sse_event('done', {'message': ''.join(pieces)})
@@ -1,9 +1,12 @@
-from fastapi import APIRouter, Depends, Form, UploadFile, File, HTTPException
+from fastapi import APIRouter, Depends, Form, UploadFile, File, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.responses import StreamingResponse
 from typing import Annotated
 from util.auth import get_current_user, oauth2_scheme
 import logging
 from util.docprocessing import *
+from util.jobs import ingest_queue, get_job
+from util.executors import run_blocking
 import os
 import time
 from util.modelparams import *
@@ -11,6 +14,7 @@ from util.modelparams import *
 
 
 router = APIRouter(
+    route_class=ContentLengthRoute,
     dependencies=[Depends(oauth2_scheme)],
     prefix='/documents',
     tags=['document processing'],
@@ -18,57 +22,71 @@ router = APIRouter(
 )
 
 
-@router.post('/upload', summary='Upload a PDF document to the server.')
+@router.post('/upload', summary='Upload a PDF document to the server.', status_code=status.HTTP_202_ACCEPTED)
+@limit_request_size(max_upload_bytes() + FORM_OVERHEAD_BYTES)
 async def upload_document(
     userinfo: Annotated[UserInfo, Depends(get_current_user)],
     file: UploadFile = File(),
     title: str = Form(default=None),
-    description: str = Form()
+    description: str = Form(),
+    chunking: str = Form(default=None),
+    chunk_size: int = Form(default=None),
+    chunk_overlap: int = Form(default=None)
 ):
-    file_proc_functions = {
-        'pdf': pdf_reader, 
-        'doc': docx_reader, 
-        'docx': docx_reader, 
-        'txt': txt_reader
-        }
+    chunking = resolve_chunking(chunking, chunk_size, chunk_overlap)
 
     if title is None or title.strip() == '':
         filename = file.filename
     else:
         filename = title
 
-    dl_path = f'./temp/{filename}'
-    ext = dl_path.split('.')[-1]
+    ext = filename.split('.')[-1]
     logging.info(f'received file: {filename} -- type: {ext}')
 
-    if ext not in file_proc_functions.keys():
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail = 'Unprocessable file type. Must be pdf, docx or txt.'
-            )
+    validate_upload(file, ext)
 
-    await download_upload_file(file, dl_path)
-    logging.info('Finished downloading file to temp.')
+    source, content_hash = await spool_upload_file(file, ext)
+    logging.info('Finished reading upload.')
 
-    logging.info('Extracting data from file...')
-    # excerpts = pdf_reader(dl_path)
-    excerpts = file_proc_functions.get(ext)(dl_path)
+    description = "" if not description else description.strip()
 
-    logging.info('dividing data in chunks...')
-    chunks = divide_into_chunks(excerpts)
+    try:
+        job_id = await run_blocking('sql', ingest_queue.submit, userinfo.userid, filename, ext, description, source, content_hash, chunking)
 
-    os.remove(dl_path)
+    except Exception as e:
+        # the job never got the upload (e.g. the sql pool was full), its temp file is released here
+        release_upload_source(source)
+        raise e
 
-    description = "" if not description else description.strip()
+    logging.info(f'queued ingest job {job_id} for file: {filename}')
+
+    return {'job_id': job_id, 'status': 'queued'}
 
-    logging.info('saving to db...')
-    doc = Document(userid=userinfo.userid, filename=filename, excerpts=chunks, description=description)
-    docid = create_new_doc(doc)
-    logging.info(f'created new doc: {docid}')
-    save_excerpts_db(doc)
-    logging.info(f'Successfully saved excerpts for doc: {docid}')
 
-    return {'doc_id': docid, 'excerpts': chunks}
+@router.get('/jobs/{job_id}', summary='Get the status of a document ingest job.')
+async def fetch_job_status(
+    userinfo: Annotated[UserInfo, Depends(get_current_user)],
+    job_id: str
+):
+    job = await run_blocking('sql', get_job, userinfo.userid, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Job not found for user.')
+
+    return job
+
+
+@router.post('/upload-batch', summary='Upload many documents or zip archives of documents at once.')
+async def upload_documents_batch(
+    userinfo: Annotated[UserInfo, Depends(get_current_user)],
+    request: Request
+):
+    # form fields: files (many), description, chunking, chunk_size, chunk_overlap
+    form_limits = dict(max_files=UPLOAD_CONFIGS['max_batch_files'], max_fields=BATCH_FORM_MAX_FIELDS)
+    async with request.form(**form_limits) as form:
+        files, description, chunking = parse_batch_form(form)
+        results = await process_document_batch(userinfo.userid, files, description, chunking)
+
+    return {'results': results}
 
 
 @router.post('/delete', summary='Remove a document from the account.')
@@ -76,30 +94,50 @@ async def delete_document(
     userinfo: Annotated[UserInfo, Depends(get_current_user)],
     doc_id: int = Form()
 ):
-    docs = get_user_files(userinfo.userid)
-    all_doc_ids = [d['doc_id'] for d in docs]
-    if doc_id not in all_doc_ids:
+    owned = await run_blocking('sql', get_owned_doc_ids, userinfo.userid, [doc_id])
+    if doc_id not in owned:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Document not found for user.')
     
-    success = delete_file(userinfo.userid, doc_id)
+    success = await run_blocking('sql', delete_file, userinfo.userid, doc_id)
 
     return {'deleted': success, 'doc_id': doc_id}
 
 
+@router.post('/delete-batch', summary='Remove many documents from the account at once.')
+async def delete_documents(
+    userinfo: Annotated[UserInfo, Depends(get_current_user)],
+    doc_ids: list[int] = Form()
+):
+    if len(doc_ids) > UPLOAD_CONFIGS['max_batch_files']:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Too many documents. At most {UPLOAD_CONFIGS["max_batch_files"]} can be deleted at once.'
+            )
+
+    deleted = await run_blocking('sql', delete_files, userinfo.userid, doc_ids)
+    not_found = sorted(set(doc_ids) - set(deleted))
+
+    return {'deleted': deleted, 'not_found': not_found}
+
+
 @router.post('/list-all', summary='Lists all documents for the user.')
 async def fetch_all_documents_for_user(
     userinfo: Annotated[UserInfo, Depends(get_current_user)]
 ):
-    docs = get_user_files(userinfo.userid)
+    docs = await run_blocking('sql', get_user_files, userinfo.userid)
     return {'documents': docs}
 
 
 @router.post('/file', summary='get extracted text for a given document for the user.')
 async def fetch_file_text(
     userinfo: Annotated[UserInfo, Depends(get_current_user)],
-    doc_id: int = Form()
+    doc_id: int = Form(),
+    stream: bool = Form(default=False)
 ):
-    return {'text': get_document(userinfo.userid, doc_id)}
+    if stream:
+        return StreamingResponse(iter_document_text(userinfo.userid, doc_id), media_type='text/plain')
+
+    return {'text': await run_blocking('sql', get_document, userinfo.userid, doc_id)}
 
 
 
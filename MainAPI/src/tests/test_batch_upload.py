@@ -0,0 +1,50 @@
+import io
+import zipfile
+import pytest
+from util import docprocessing
+from util.docprocessing import iter_archive_files
+
+
+def make_archive(members: dict, encrypted=()) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    data = bytearray(buffer.getvalue())
+
+    # mark members as encrypted in the central directory, which is what zipfile checks on open
+    offset = data.find(b'PK\x01\x02')
+    while offset != -1:
+        name_length = int.from_bytes(data[offset + 28:offset + 30], 'little')
+        name = data[offset + 46:offset + 46 + name_length].decode()
+        if name in encrypted:
+            data[offset + 8] |= 0x1
+        offset = data.find(b'PK\x01\x02', offset + 46)
+    return bytes(data)
+
+
+@pytest.fixture(autouse=True)
+def small_spool(monkeypatch, tmp_path):
+    monkeypatch.setitem(docprocessing.UPLOAD_CONFIGS, 'spool_threshold_mb', 0)
+    monkeypatch.setitem(docprocessing.UPLOAD_CONFIGS, 'temp_dir', str(tmp_path))
+
+
+def test_unreadable_member_is_a_file_error(tmp_path):
+    source = make_archive({'a.txt': b'first', 'b.txt': b'second'}, encrypted={'a.txt'})
+    entries = list(iter_archive_files(source, 10))
+
+    assert entries[0]['filename'] == 'a.txt' and 'error' in entries[0]
+    assert entries[1]['filename'] == 'b.txt' and 'error' not in entries[1]
+    # only the readable member is left spooled
+    assert [p.name for p in tmp_path.iterdir()] == [entries[1]['source'].split('/')[-1]]
+    docprocessing.release_upload_source(entries[1]['source'])
+
+
+def test_members_past_the_limit_are_not_extracted(tmp_path):
+    source = make_archive({f'{i}.txt': b'text' for i in range(4)})
+    entries = list(iter_archive_files(source, 2))
+
+    assert [entry.get('error') for entry in entries] == [None, None, docprocessing.TOO_MANY_FILES_ERROR, docprocessing.TOO_MANY_FILES_ERROR]
+    assert len(list(tmp_path.iterdir())) == 2
+    for entry in entries[:2]:
+        docprocessing.release_upload_source(entry['source'])
@@ -0,0 +1,96 @@
+import re
+import pytest
+from util import docprocessing
+from util.docprocessing import iter_chunks, iter_token_chunks
+
+
+def split_sentences(s: str) -> list:
+    return re.split(r'(?<=\.)\s+', s.strip()) if s.strip() else []
+
+
+@pytest.fixture(autouse=True)
+def plain_tokenizers(monkeypatch):
+    '''
+    Sentences end with a period and every word is one token, so chunk boundaries are easy to check.
+    '''
+    monkeypatch.setattr(docprocessing, 'sent_tokenize', split_sentences)
+    monkeypatch.setattr(docprocessing.registry, 'ensure_punkt', lambda: None)
+    monkeypatch.setattr(docprocessing, 'count_tokens', lambda s: len(s.split()))
+
+
+def sentences(count: int, words=3) -> list:
+    return [' '.join(f'w{i}' for _ in range(words - 1)) + f' s{i}.' for i in range(count)]
+
+
+def reference_chunks(document: str, chunk_size: int, overlap: int) -> list:
+    '''
+    The original list based divide_into_chunks.
+    '''
+    parts = [s.strip() for s in split_sentences(document) if len(s.strip()) > 0]
+    chunks, start = [], 0
+    while start < len(parts):
+        chunks.append(' '.join(parts[start: min(start + chunk_size, len(parts))]))
+        start += chunk_size - overlap
+    return chunks
+
+
+@pytest.mark.parametrize('chunk_size,overlap', [(10, 3), (4, 1), (3, 0), (1, 0), (5, 4)])
+@pytest.mark.parametrize('count', [0, 1, 2, 3, 7, 10, 11, 17, 25])
+def test_iter_chunks_matches_divide_into_chunks(count, chunk_size, overlap):
+    document = ' '.join(sentences(count))
+    chunks = list(iter_chunks([document], chunk_size=chunk_size, overlap=overlap))
+
+    assert [c.text for c in chunks] == reference_chunks(document, chunk_size, overlap)
+
+
+@pytest.mark.parametrize('chunk_size,overlap', [(10, 3), (4, 1), (3, 0), (5, 4)])
+@pytest.mark.parametrize('count', [1, 7, 10, 11, 25])
+def test_iter_chunks_bodies_rebuild_document(count, chunk_size, overlap):
+    parts = sentences(count)
+    chunks = list(iter_chunks([' '.join(parts)], chunk_size=chunk_size, overlap=overlap))
+
+    assert ' '.join(c.body for c in chunks) == ' '.join(parts)
+
+
+def test_iter_chunks_joins_sentences_split_across_pieces():
+    pieces = ['One two. Three', 'four five. Six.']
+    chunks = list(iter_chunks(pieces, chunk_size=2, overlap=1))
+
+    assert [c.text for c in chunks] == ['One two. Three four five.', 'Three four five. Six.', 'Six.']
+
+
+@pytest.mark.parametrize('chunk_size,overlap', [(6, 0), (6, 3), (9, 3), (10, 8), (4, 3)])
+@pytest.mark.parametrize('count', [0, 1, 2, 5, 12])
+def test_iter_token_chunks_fit_and_overlap(count, chunk_size, overlap):
+    parts = sentences(count)
+    chunks = list(iter_token_chunks([' '.join(parts)], chunk_size=chunk_size, overlap=overlap))
+
+    assert ' '.join(c.body for c in chunks) == ' '.join(parts)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # the next chunk starts with what the previous one did not keep in its body
+        repeated = previous.text[len(previous.body):].strip()
+        assert chunk.text.startswith(repeated)
+        assert len(repeated.split()) <= overlap
+        assert chunk.text != previous.text
+
+    for chunk in chunks:
+        assert chunk.tokens == len(chunk.text.split())
+        assert chunk.tokens <= chunk_size
+
+
+def test_iter_token_chunks_long_sentence_is_its_own_chunk():
+    long_sentence = ' '.join(['word'] * 12) + '.'
+    pieces = ['a b c. ' + long_sentence + ' d e f.']
+    chunks = list(iter_token_chunks(pieces, chunk_size=6, overlap=3))
+
+    assert [c.text for c in chunks] == ['a b c.', long_sentence, 'd e f.']
+    assert chunks[1].tokens == 12
+
+
+def test_iter_token_chunks_overlap_leaves_room_for_next_sentence():
+    # the overlap budget shrinks so the previous sentence plus the incoming one still fit
+    pieces = ['a b c. d e. f g h i.']
+    chunks = list(iter_token_chunks(pieces, chunk_size=6, overlap=4))
+
+    assert [c.text for c in chunks] == ['a b c. d e.', 'd e. f g h i.']
+    assert [c.body for c in chunks] == ['a b c.', 'd e. f g h i.']
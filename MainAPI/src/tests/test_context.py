@@ -0,0 +1,54 @@
+import re
+import pytest
+from util import context
+from util.context import build_context, merge_adjacent
+
+
+def split_sentences(s: str) -> list:
+    return re.split(r'(?<=\.)\s+', s.strip()) if s.strip() else []
+
+
+@pytest.fixture(autouse=True)
+def plain_tokenizers(monkeypatch):
+    '''
+    Sentences end with a period and every word is one token.
+    '''
+    monkeypatch.setattr(context, 'split_sentences', split_sentences)
+    monkeypatch.setattr(context, 'count_tokens', lambda s: len(s.split()))
+
+
+def excerpt(id, text, doc_id=1, distance=0.1):
+    return {'id': str(id), 'doc_id': doc_id, 'text': text, 'distance': distance}
+
+
+def test_overlapping_excerpts_merge_across_id_gaps():
+    groups = merge_adjacent([excerpt(12, 'C one. D one.'), excerpt(3, 'A one. B one. C one.')])
+
+    assert len(groups) == 1
+    assert groups[0]['ids'] == ['3', '12']
+    assert groups[0]['sentences'] == ['A one.', 'B one.', 'C one.', 'D one.']
+    assert groups[0]['starts'] == [0, 2]
+
+
+def test_unrelated_excerpts_stay_apart():
+    groups = merge_adjacent([excerpt(3, 'A one.'), excerpt(12, 'D one.'), excerpt(4, 'X one.', doc_id=2)])
+
+    assert sorted(g['ids'] for g in groups) == [['12'], ['3'], ['4']]
+
+
+def test_consecutive_excerpts_merge_without_overlap():
+    groups = merge_adjacent([excerpt(3, 'A one.'), excerpt(4, 'B one.')])
+
+    assert [g['ids'] for g in groups] == [['3', '4']]
+
+
+def test_cut_passage_reports_only_included_excerpts():
+    passages, report = build_context([excerpt(3, 'A one. B one. C one.'), excerpt(9, 'C one. D one. E one.')], max_tokens=5)
+
+    assert passages == ['A one. B one.']
+    assert report['excerpts'] == ['3']
+
+    passages, report = build_context([excerpt(3, 'A one. B one. C one.'), excerpt(9, 'C one. D one. E one.')], max_tokens=7)
+
+    assert passages == ['A one. B one. C one.']
+    assert report['excerpts'] == ['3', '9']
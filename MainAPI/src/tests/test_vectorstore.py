@@ -0,0 +1,94 @@
+import os
+import numpy as np
+import pytest
+from util.vectorstore import NumpyBackend
+
+
+DIM = 8
+
+
+def vectors(count: int, seed=0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float32)
+
+
+def add_rows(backend, ids, docid, seed=0):
+    v = vectors(len(ids), seed)
+    backend.add(1, ids=list(ids), embeddings=v.tolist(), documents=[f'excerpt {i}' for i in ids], docids=[docid] * len(ids))
+    return v
+
+
+def best(backend, query, **kwargs) -> dict:
+    return backend.query(1, [query.tolist()], 1, **kwargs)[0][0]
+
+
+@pytest.fixture(params=['none', 'int8'])
+def backend(request, tmp_path):
+    return NumpyBackend(str(tmp_path), quantization=request.param, rescore_factor=4)
+
+
+def test_append_and_query(backend):
+    v = add_rows(backend, range(0, 5), docid=1)
+    add_rows(backend, range(5, 10), docid=2, seed=1)
+
+    hit = best(backend, v[3])
+    assert hit == {'id': '3', 'doc_id': 1, 'distance': pytest.approx(0.0, abs=1e-2), 'text': 'excerpt 3'}
+    assert all(e['doc_id'] == 2 for e in backend.query(1, [v[3].tolist()], 10, doc_ids=[2])[0])
+
+
+def test_append_skips_stored_ids(backend):
+    add_rows(backend, range(0, 5), docid=1)
+    add_rows(backend, range(3, 8), docid=1)
+
+    assert sorted(int(e['id']) for e in backend.query(1, [vectors(1)[0].tolist()], 20)[0]) == list(range(8))
+
+
+def test_remove_docs(backend):
+    add_rows(backend, range(0, 5), docid=1)
+    v = add_rows(backend, range(5, 10), docid=2, seed=1)
+
+    assert backend.delete(1, [1])
+    results = backend.query(1, [v[2].tolist()], 20)[0]
+    assert sorted(int(e['id']) for e in results) == list(range(5, 10))
+    assert all(e['text'] == f'excerpt {e["id"]}' for e in results)
+    assert not backend.delete(1, [1])
+
+
+def test_append_drops_rows_of_a_failed_append(backend):
+    v = add_rows(backend, range(0, 3), docid=1)
+    path = backend.index(1).path
+
+    # a failed append wrote a row to some columns but never got to ids.i64
+    with open(os.path.join(path, 'docids.i64'), 'ab') as file:
+        file.write(np.array([99], dtype=np.int64).tobytes())
+    with open(os.path.join(path, 'texts.bin'), 'ab') as file:
+        file.write(b'stray text')
+
+    w = add_rows(backend, range(3, 6), docid=2, seed=1)
+
+    assert best(backend, v[1]) == {'id': '1', 'doc_id': 1, 'distance': pytest.approx(0.0, abs=1e-2), 'text': 'excerpt 1'}
+    assert best(backend, w[0]) == {'id': '3', 'doc_id': 2, 'distance': pytest.approx(0.0, abs=1e-2), 'text': 'excerpt 3'}
+    assert all(e['doc_id'] == 2 for e in backend.query(1, [w[0].tolist()], 10, doc_ids=[2])[0])
+
+
+def test_interrupted_rewrite_is_finished(backend, tmp_path, monkeypatch):
+    add_rows(backend, range(0, 5), docid=1)
+    v = add_rows(backend, range(5, 10), docid=2, seed=1)
+
+    replace, calls = os.replace, []
+    def failing_replace(src, dst):
+        calls.append(dst)
+        if len(calls) == 2:
+            raise OSError('interrupted')
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', failing_replace)
+    with pytest.raises(OSError):
+        backend.delete(1, [1])
+    monkeypatch.setattr(os, 'replace', replace)
+
+    # a new process opening the same files
+    reopened = NumpyBackend(str(tmp_path), quantization=backend.quantization, rescore_factor=4)
+    results = reopened.query(1, [v[2].tolist()], 20)[0]
+    assert sorted(int(e['id']) for e in results) == list(range(5, 10))
+    assert all(e['text'] == f'excerpt {e["id"]}' and e['doc_id'] == 2 for e in results)
+    assert not any(name.endswith('.tmp') or name == 'rewrite' for name in os.listdir(reopened.index(1).path))
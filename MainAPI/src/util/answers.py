@@ -0,0 +1,67 @@
+import math
+import logging
+from util.util import read_configs
+from util.metrics import metrics
+from util.cache import LRUCache
+from util.resources import registry
+
+
+logging.basicConfig(level=logging.INFO)
+ANSWER_CONFIGS = read_configs(filename='config.json')['cache']['answers']
+
+
+def unit_vector(embedding) -> list:
+    norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+    return [x / norm for x in embedding]
+
+
+class SemanticAnswerCache():
+    '''
+    Caches LLM answers per user, corpus version and exact set of retrieved excerpt ids.
+    An answer is reused for a new question whose embedding has at least min_similarity cosine
+    similarity to a cached question answered from the same excerpts. The corpus version in
+    the key drops every entry of a user as soon as their documents change.
+    '''
+    def __init__(self, maxsize: int, ttl: int, min_similarity: float, per_key: int):
+        self.__entries = LRUCache('answer_set', maxsize, ttl=ttl)
+        self.min_similarity = min_similarity
+        self.per_key = per_key
+
+
+    @staticmethod
+    def key(userid: int, version: int, excerpts: list) -> tuple:
+        return (userid, version, frozenset(e['id'] for e in excerpts))
+
+
+    def get(self, key: tuple, embedding: list):
+        '''
+        Returns the cached answer of the most similar question for the key, or None.
+        '''
+        query = unit_vector(embedding)
+        best, best_similarity = None, self.min_similarity
+        for cached, answer in self.__entries.get(key, []):
+            similarity = sum(a * b for a, b in zip(query, cached))
+            if similarity >= best_similarity:
+                best, best_similarity = answer, similarity
+
+        metrics.incr('answer_cache_hits' if best is not None else 'answer_cache_misses')
+        return best
+
+
+    def set(self, key: tuple, embedding: list, answer: str):
+        # the newest questions are kept when a key has more than per_key of them
+        entries = self.__entries.get(key, []) + [(unit_vector(embedding), answer)]
+        self.__entries.set(key, entries[-self.per_key:])
+
+
+answer_cache = SemanticAnswerCache(
+    ANSWER_CONFIGS['size'], ANSWER_CONFIGS['ttl'], ANSWER_CONFIGS['min_similarity'], ANSWER_CONFIGS['per_key']
+    )
+
+
+def cached_answer(query: str, key: tuple):
+    '''
+    Looks up an answer for the query, returns (answer or None, query embedding).
+    '''
+    embedding = registry.vectordb.embed_query(query)
+    return answer_cache.get(key, embedding), embedding
@@ -5,7 +5,8 @@ from fastapi import Depends, HTTPException, status
 from sqlalchemy import create_engine, text
 from util.util import *
 from util.modelparams import *
-from util.db import MySQLDatabase
+from util.resources import registry
+from util.executors import run_blocking
 import bcrypt
 import uuid
 import re
@@ -13,7 +14,7 @@ from jose import jwt, JWTError
 from datetime import datetime, timedelta, timezone
 
 
-database = MySQLDatabase()
+database = registry.database
 configs = read_configs()
 
 JWT_SECRET_KEY = configs['auth']['jwt_key']
@@ -30,7 +31,7 @@ async def get_current_user_for_pw_reset(token: Annotated[str, Depends(oauth2_sch
         headers={'WWW-Authenticate': 'Bearer'}
     )
 
-    if not valid_jwt_token(token):
+    if not await run_blocking('sql', valid_jwt_token, token):
         raise cred_exception
     
     try:
@@ -46,7 +47,7 @@ async def get_current_user_for_pw_reset(token: Annotated[str, Depends(oauth2_sch
         logging.info(f'error validating jwt token: {e}')
         raise cred_exception
     
-    user = get_user_info(username)
+    user = await run_blocking('sql', get_user_info, username)
     if not user:
         raise cred_exception
     return user
@@ -60,7 +61,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     )
     
     #check if token is blacklisted
-    if not valid_jwt_token(token):
+    if not await run_blocking('sql', valid_jwt_token, token):
         raise cred_exception
 
     try:
@@ -76,7 +77,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
         logging.info(f'error validating jwt token: {e}')
         raise cred_exception
     
-    user = get_user_info(username)
+    user = await run_blocking('sql', get_user_info, username)
     if not user:
         raise cred_exception
     return user
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+from util.metrics import metrics
+
+
+class LRUCache():
+    '''
+    Thread safe LRU cache with an optional time to live (seconds) for entries.
+    Hits and misses are counted in metrics as {name}_cache_hits / {name}_cache_misses.
+    '''
+    def __init__(self, name: str, maxsize: int, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__data.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self.__data[key]
+                entry = None
+
+            if entry is None:
+                metrics.incr(f'{self.name}_cache_misses')
+                return default
+
+            self.__data.move_to_end(key)
+            metrics.incr(f'{self.name}_cache_hits')
+            return entry[1]
+
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.__lock:
+            self.__data[key] = (expires, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+
+    def pop(self, key):
+        with self.__lock:
+            entry = self.__data.pop(key, None)
+            return entry[1] if entry else None
+
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+
+    def __len__(self):
+        return len(self.__data)
+
+
+class CorpusVersions():
+    '''
+    Per user counter bumped whenever the user's documents change. Caches include the
+    version in their keys so entries from before a change are never served again.
+    '''
+    def __init__(self):
+        self.__versions = {}
+        self.__lock = threading.Lock()
+
+
+    def get(self, userid: int) -> int:
+        with self.__lock:
+            return self.__versions.get(userid, 0)
+
+
+    def bump(self, userid: int):
+        with self.__lock:
+            self.__versions[userid] = self.__versions.get(userid, 0) + 1
+
+
+corpus_versions = CorpusVersions()
@@ -0,0 +1,106 @@
+import logging
+from nltk.tokenize import sent_tokenize
+from util.util import read_configs
+from util.metrics import metrics
+from util.resources import registry
+from util.tokens import count_tokens
+
+
+logging.basicConfig(level=logging.INFO)
+CONTEXT_CONFIGS = read_configs(filename='config.json')['context']
+
+
+def split_sentences(s: str) -> list:
+    registry.ensure_punkt()
+    return [' '.join(sentence.split()) for sentence in sent_tokenize(s) if sentence.strip()]
+
+
+def overlap_length(previous: list, current: list) -> int:
+    '''
+    Number of sentences at the start of current that repeat the end of previous.
+    '''
+    for k in range(min(len(previous), len(current)), 0, -1):
+        if previous[-k:] == current[:k]:
+            return k
+
+    return 0
+
+
+def merge_adjacent(excerpts: list) -> list:
+    '''
+    Groups excerpts of the same document that follow each other (in excerpt id order) into one
+    passage when their ids are consecutive or the later one starts with sentences the passage
+    ends with, dropping the repeated sentences. Ids of one document are not always consecutive
+    since excerpts of concurrent ingests share the id sequence.
+
+    Returns [{'ids', 'sentences', 'starts', 'distance', 'rank'}] where starts[i] is the index of
+    the first sentence of excerpt ids[i] in sentences, distance is the best distance of the
+    group (None if only found lexically) and rank the best position in excerpts.
+    '''
+    ranked = [dict(e, rank=i) for i, e in enumerate(excerpts)]
+    ranked.sort(key=lambda e: (str(e.get('doc_id')), int(e['id']) if str(e['id']).isdigit() else -1))
+
+    groups, previous = [], None
+    for excerpt in ranked:
+        sentences = split_sentences(excerpt['text'])
+        same_doc = (
+            previous is not None and excerpt.get('doc_id') is not None
+            and excerpt.get('doc_id') == previous.get('doc_id')
+            and str(excerpt['id']).isdigit() and str(previous['id']).isdigit()
+            )
+        overlap = overlap_length(groups[-1]['sentences'], sentences) if same_doc else 0
+
+        if same_doc and (overlap > 0 or int(excerpt['id']) == int(previous['id']) + 1):
+            group = groups[-1]
+            group['starts'].append(len(group['sentences']) - overlap)
+            group['sentences'] += sentences[overlap:]
+            group['ids'].append(excerpt['id'])
+            group['rank'] = min(group['rank'], excerpt['rank'])
+            if excerpt['distance'] is not None:
+                group['distance'] = excerpt['distance'] if group['distance'] is None else min(group['distance'], excerpt['distance'])
+        else:
+            groups.append({'ids': [excerpt['id']], 'sentences': sentences, 'starts': [0], 'distance': excerpt['distance'], 'rank': excerpt['rank']})
+
+        previous = excerpt
+
+    return groups
+
+
+def build_context(excerpts: list, max_tokens=None) -> tuple[list, dict]:
+    '''
+    Builds the context passed to the LLM from retrieved excerpts: adjacent excerpts are merged
+    without their overlapping sentences, passages are ranked by distance (lexical only hits
+    after them in retrieval order) and added until context.max_tokens is reached, the last
+    one cut at a sentence boundary.
+
+    Returns the passages and a report {'excerpts', 'passages', 'tokens', 'tokens_saved'}.
+    '''
+    max_tokens = CONTEXT_CONFIGS['max_tokens'] if max_tokens is None else max_tokens
+    raw_tokens = sum(count_tokens(e['text']) for e in excerpts)
+
+    groups = merge_adjacent(excerpts)
+    groups.sort(key=lambda g: (g['distance'] is None, g['distance'] or 0.0, g['rank']))
+
+    passages, used, total = [], [], 0
+    for group in groups:
+        sentences = []
+        for sentence in group['sentences']:
+            tokens = count_tokens(sentence)
+            if total + tokens > max_tokens:
+                break
+            sentences.append(sentence)
+            total += tokens
+
+        if sentences:
+            passages.append(' '.join(sentences))
+            # a passage cut short only uses the excerpts that start before the cut
+            used.extend(i for i, start in zip(group['ids'], group['starts']) if start < len(sentences))
+
+        if total >= max_tokens:
+            break
+
+    tokens = sum(count_tokens(p) for p in passages)
+    report = {'excerpts': used, 'passages': len(passages), 'tokens': tokens, 'tokens_saved': max(raw_tokens - tokens, 0)}
+    metrics.observe('context_tokens', tokens)
+    metrics.observe('context_tokens_saved', report['tokens_saved'])
+    return passages, report
@@ -1,8 +1,11 @@
 import sqlalchemy
-from sqlalchemy import create_engine
-from util.util import read_configs
+from sqlalchemy import create_engine, text
+from array import array
+from util.util import read_configs, hash_text, normalize_query
+from util.metrics import metrics
+from util.cache import LRUCache
+from util.vectorstore import get_vector_backend
 import logging
-import chromadb
 from util.modelparams import Document
 
 logging.basicConfig(level=logging.INFO)
@@ -33,58 +36,198 @@ class MySQLDatabase():
         return self.__db
 
 
-class VectorDB():
-    def __init__(self, threshold=1.5) -> None:
-        self.configs = read_configs(filename='config.json')
-        self.client = chromadb.PersistentClient(path = self.configs['database']['chromadb'])
-        self.threshold = threshold
-
-
-    def add_file(self, userid: int, docid: int, excerpts: list):
-        collection = self.client.get_or_create_collection(f'user-{userid}')
-        
-        documents, ids = [], []
-        for e in excerpts:
-            documents.append(e['excerpt'])
-            ids.append(str(e['excerpt_id'])) 
-
-        collection.add(
-            documents=documents,
-            metadatas=[{'docid': docid} for i in range(len(documents))],
-            ids=ids
+DEFAULT_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+EMBEDDING_CACHE_BATCH_SIZE = 1000
+
+
+class EmbeddingCache():
+    '''
+    Embeddings shared by every user in the embedding_cache table, keyed by the sha256 of the
+    text and the embedding model, stored as float32 bytes.
+    Entries of excerpts are removed by prune_embeddings once no excerpt with that text is left,
+    shared query embeddings (query_only) expire after cache.query_embeddings.shared_ttl seconds.
+    '''
+    def __init__(self, database: MySQLDatabase, model: str, query_ttl: int):
+        self.database = database
+        self.model = model
+        self.query_ttl = query_ttl
+
+
+    def get(self, hashes: list) -> dict:
+        '''
+        Returns {hash: embedding} for the hashes found in the cache.
+        '''
+        hashes = list(set(hashes))
+        embeddings = {}
+        with self.database.db.connect() as conn:
+            for start in range(0, len(hashes), EMBEDDING_CACHE_BATCH_SIZE):
+                batch = hashes[start: start+EMBEDDING_CACHE_BATCH_SIZE]
+                params = {f'hash_{i}': h for i, h in enumerate(batch)}
+                hash_list = ', '.join(f':hash_{i}' for i in range(len(batch)))
+                query = text(f'SELECT text_hash, embedding FROM embedding_cache WHERE model=:model AND text_hash IN ({hash_list});')
+                for text_hash, embedding in conn.execute(query, dict(params, model=self.model)).fetchall():
+                    embeddings[text_hash] = array('f', embedding).tolist()
+
+        return embeddings
+
+
+    def set(self, embeddings: dict, query_only=False):
+        '''
+        Stores {hash: embedding}. An entry stored for an excerpt is never turned back into a query only one.
+        '''
+        items = list(embeddings.items())
+        with self.database.db.connect() as conn:
+            for start in range(0, len(items), EMBEDDING_CACHE_BATCH_SIZE):
+                params, values = {'model': self.model, 'query_only': query_only}, []
+                for i, (h, embedding) in enumerate(items[start: start+EMBEDDING_CACHE_BATCH_SIZE]):
+                    values.append(f'(:model, :hash_{i}, :embedding_{i}, :query_only)')
+                    params[f'hash_{i}'] = h
+                    params[f'embedding_{i}'] = array('f', embedding).tobytes()
+
+                query = text(
+                    f'INSERT INTO embedding_cache (model, text_hash, embedding, query_only) VALUES {", ".join(values)} '
+                    'ON DUPLICATE KEY UPDATE query_only=query_only AND VALUES(query_only);'
+                    )
+                conn.execute(query, params)
+
+            if query_only:
+                query = text(
+                    'DELETE FROM embedding_cache WHERE query_only=TRUE '
+                    'AND created_ts < NOW() - INTERVAL :ttl SECOND LIMIT 1000;'
+                    )
+                conn.execute(query, dict(ttl=self.query_ttl))
+
+            conn.commit()
+
+
+def prune_embeddings(conn, doc_ids: list):
+    '''
+    Removes the cached embeddings of the documents' excerpts that no other excerpt shares,
+    inside the caller's transaction. Must run before the excerpts are deleted.
+    '''
+    doc_list = ', '.join(str(int(d)) for d in doc_ids)
+    query = text(
+        'DELETE embedding_cache FROM embedding_cache '
+        f'JOIN (SELECT DISTINCT excerpt_hash FROM excerpts WHERE doc_id IN ({doc_list})) AS removed '
+        'ON embedding_cache.text_hash=removed.excerpt_hash '
+        'WHERE NOT EXISTS (SELECT 1 FROM excerpts AS remaining WHERE remaining.excerpt_hash=removed.excerpt_hash '
+        f'AND remaining.doc_id NOT IN ({doc_list}));'
         )
+    conn.execute(query)
 
-    
-    def delete(self, userid:int, docid: int):
-        try:
-            collection = self.client.get_collection(f'user-{userid}')
-            collection.delete(where={'docid': docid})
 
-        except ValueError as e:
-            logging.info('Could not find collection. error: ' + str(e))
-            return False
+def get_embedding_function(model: str):
+    from chromadb.utils import embedding_functions
 
+    if model == DEFAULT_EMBEDDING_MODEL:
+        return embedding_functions.DefaultEmbeddingFunction()
 
-    def query(self, s: str, userid: int):
-        userid = f'user-{userid}'
-        try:
-            collection = self.client.get_collection(userid)
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model)
 
-        except ValueError as e:
-            logging.info('Could not find collection. error: ' + str(e))
-            return []
 
-        excerpts = collection.query(query_texts=s)
-        result = []
+class VectorDB():
+    def __init__(self, database: MySQLDatabase, threshold=1.5) -> None:
+        # imported here since chromadb is slow to import and only needed once a VectorDB is created
+        import chromadb
 
-        excerpts = zip(excerpts['ids'][0], excerpts['distances'][0], excerpts['documents'][0])
+        self.configs = read_configs(filename='config.json')
+        self.threshold = threshold
+        self.model = self.configs['database'].get('embedding_model', DEFAULT_EMBEDDING_MODEL)
+        self.embedding_function = get_embedding_function(self.model)
+
+        query_configs = self.configs['cache']['query_embeddings']
+        self.query_cache = LRUCache('query_embedding', query_configs['size'])
+        self.share_query_embeddings = query_configs['shared']
+        self.embedding_cache = EmbeddingCache(database, self.model, query_configs['shared_ttl'])
+
+        # the chroma client is only opened when chroma holds the excerpts
+        backend = self.configs['database'].get('vector_backend', 'chroma')
+        self.client = chromadb.PersistentClient(path = self.configs['database']['chromadb']) if backend == 'chroma' else None
+        self.backend = get_vector_backend(backend, self.configs, client=self.client, embedding_function=self.embedding_function)
+
+
+    def embed_excerpts(self, excerpts: list) -> list:
+        '''
+        Gets the embeddings for the excerpts, only running the model for text that is not
+        in the shared embedding cache yet.
+        '''
+        hashes = [e.get('excerpt_hash') or hash_text(e['excerpt']) for e in excerpts]
+        embeddings = self.embedding_cache.get(hashes)
+
+        missing = {}
+        for h, e in zip(hashes, excerpts):
+            if h not in embeddings:
+                missing[h] = e['excerpt']
+
+        if missing:
+            new_embeddings = dict(zip(missing.keys(), self.embedding_function(list(missing.values()))))
+            self.embedding_cache.set(new_embeddings)
+            embeddings.update(new_embeddings)
+
+        metrics.incr('embedding_cache_hits', len(hashes) - len(missing))
+        metrics.incr('embedding_cache_misses', len(missing))
+        return [embeddings[h] for h in hashes]
+
+
+    def embed_query(self, s: str) -> list:
+        '''
+        Gets the embedding of a query from the in process LRU cache, then (if enabled) the
+        shared embedding cache table, and only embeds it on a miss in both.
+        The model lower cases its input so the normalized query embeds the same as the original.
+        '''
+        s = normalize_query(s)
+        key = (self.model, s)
+        embedding = self.query_cache.get(key)
+        if embedding is not None:
+            return embedding
+
+        if self.share_query_embeddings:
+            # same keys as excerpt embeddings, identical text has an identical embedding
+            embedding = self.embedding_cache.get([hash_text(s)]).get(hash_text(s))
+
+        if embedding is None:
+            embedding = self.embedding_function([s])[0]
+            if self.share_query_embeddings:
+                self.embedding_cache.set({hash_text(s): embedding}, query_only=True)
+
+        self.query_cache.set(key, embedding)
+        return embedding
 
-        for id, d, text in excerpts:
-            if d <= self.threshold:
-                result.append({'id': id, 'distance': d, 'text': text})
 
-        return result
+    def add_file(self, userid: int, docid: int, excerpts: list):
+        self.add_excerpts(userid, [dict(e, doc_id=docid) for e in excerpts])
+
+
+    def add_excerpts(self, userid: int, excerpts: list, embeddings=None):
+        '''
+        Adds excerpts of any of the user's documents, each excerpt carries its own doc_id.
+        embeddings can be passed in when they were computed ahead of time.
+        '''
+        self.backend.add(
+            userid,
+            ids=[e['excerpt_id'] for e in excerpts],
+            embeddings=self.embed_excerpts(excerpts) if embeddings is None else embeddings,
+            documents=[e['excerpt'] for e in excerpts],
+            docids=[e['doc_id'] for e in excerpts]
+        )
 
     
+    def delete(self, userid:int, docid: int):
+        return self.backend.delete(userid, [docid])
+
+
+    def delete_many(self, userid: int, docids: list):
+        '''
+        Removes the vectors of many documents with a single batched delete.
+        '''
+        return self.backend.delete(userid, docids)
 
 
+    def query(self, s: str, userid: int, n_results=10, threshold=None, doc_ids=None):
+        '''
+        Finds the n_results excerpts closest to s within threshold (defaulting to self.threshold),
+        only searching the documents in doc_ids if given.
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        excerpts = self.backend.query(userid, [self.embed_query(s)], n_results, doc_ids)[0]
+        return [e for e in excerpts if e['distance'] <= threshold]
@@ -4,36 +4,206 @@ from nltk.tokenize import sent_tokenize
 from fastapi import HTTPException, status
 import fitz
 import re
-from util.db import MySQLDatabase, VectorDB
+from util.resources import registry
 from util.modelparams import *
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.routing import APIRoute
+from starlette.datastructures import UploadFile as StarletteUploadFile
 from sqlalchemy import create_engine, text
+from util.util import read_configs, hash_text
+from util.metrics import metrics
+from util.cache import LRUCache, corpus_versions
+from util.tokens import count_tokens
+from util.lexical import excerpt_terms, index_excerpts, add_lexical_stats, unindex_documents
+from util.db import prune_embeddings
+from concurrent.futures import ProcessPoolExecutor
+import concurrent.futures
+from util.executors import run_blocking
+import itertools
+import multiprocessing
+import zipfile
+import asyncio
+import hashlib
+import threading
 import logging
+import tempfile
+import math
+import codecs
+import time
+import io
+import os
 
 
 logging.basicConfig(level=logging.INFO)
-nltk.download('punkt')
-database = MySQLDatabase()
-vectordb = VectorDB()
-
-# Define a function to divide the input document into overlapping chunks
-def divide_into_chunks(document, chunk_size=10, overlap=3):
-    # Split the document into sentences using nltk tokenize
-    sentences = sent_tokenize(document)
-    # sentences = document.split('.')
-    sentences = [s.strip() for s in sentences if len(s.strip()) > 0]
-    # Divide the sentences into overlapping chunks
-    chunks = []
-    start_idx = 0
-    while start_idx < len(sentences):
-        end_idx = min(start_idx + chunk_size, len(sentences))
-        chunk = " ".join(sentences[start_idx:end_idx])
-        chunks.append(chunk)
-        start_idx += chunk_size - overlap
-    return chunks
+database = registry.database
+UPLOAD_CONFIGS = read_configs(filename='config.json')['upload']
+INGEST_CONFIGS = read_configs(filename='config.json')['ingest']
+CACHE_CONFIGS = read_configs(filename='config.json')['cache']
+CHUNKING_CONFIGS = read_configs(filename='config.json')['chunking']
+
+# reconstructed text of recently read documents, keyed by (user_id, doc_id). The cache is per
+# process, so a delete handled by another worker only shows up here once the entry expires
+document_cache = LRUCache('document', CACHE_CONFIGS['documents']['size'], ttl=CACHE_CONFIGS['documents']['ttl'])
+
+# created on first use so importing this module never starts worker processes
+pdf_pool = None
+pdf_pool_lock = threading.Lock()
+
+# leading bytes expected for each accepted extension. doc is read with python-docx so it
+# must be a zip based (docx) file as well. None means any content is accepted.
+FILE_SIGNATURES = {
+    'pdf': (b'%PDF',),
+    'doc': (b'PK\x03\x04',),
+    'docx': (b'PK\x03\x04',),
+    'txt': None
+}
+# batch uploads can also contain zip archives of the types above
+BATCH_SIGNATURES = dict(FILE_SIGNATURES, zip=(b'PK\x03\x04',))
+
+
+def iter_sentences(pieces):
+    '''
+    Yields the sentences of a stream of text pieces (pages, paragraphs, blocks of lines).
+    The last sentence of each piece is carried over to the next one since it may continue there.
+    '''
+    registry.ensure_punkt()
+    carry = ''
+    for piece in pieces:
+        sentences = [s.strip() for s in sent_tokenize(carry + ' ' + piece if carry else piece)]
+        sentences = [s for s in sentences if len(s) > 0]
+        if not sentences:
+            continue
+
+        carry = sentences.pop()
+        yield from sentences
+
+    if carry:
+        yield carry
+
+
+def iter_chunks(pieces, chunk_size=10, overlap=3):
+    '''
+    Lazily divides a stream of text pieces into chunks of chunk_size sentences where
+    consecutive chunks share overlap sentences. Produces the same chunks as the original list
+    based chunker while only holding one chunk worth of sentences in memory.
+
+    Each Chunk also carries its body, the sentences not repeated by the next chunk, so the
+    document can be rebuilt by joining bodies without re-tokenizing.
+    '''
+    step = chunk_size - overlap
+    window = []
+    for sentence in iter_sentences(pieces):
+        window.append(sentence)
+        if len(window) == chunk_size:
+            yield Chunk(text=' '.join(window), body=' '.join(window[:step]))
+            del window[:step]
+
+    # the tail still starts a chunk at every step, same as the original chunker
+    while window:
+        sentences = window[:chunk_size]
+        del window[:step]
+        body = sentences[:step] if window else sentences
+        yield Chunk(text=' '.join(sentences), body=' '.join(body))
+
+
+def iter_token_chunks(pieces, chunk_size=256, overlap=48):
+    '''
+    Lazily divides a stream of text pieces into chunks of whole sentences holding at most
+    chunk_size tokens, where each chunk starts with the trailing sentences of the previous one
+    that fit in overlap tokens. A single sentence longer than chunk_size becomes its own chunk.
+    '''
+    window = []
+    window_tokens = 0
+    for sentence in iter_sentences(pieces):
+        tokens = count_tokens(sentence)
+        if window and window_tokens + tokens > chunk_size:
+            # keep as many trailing sentences as fit in the overlap (and leave room for the
+            # incoming sentence), but always move forward
+            keep = len(window)
+            overlap_tokens = 0
+            overlap_budget = min(overlap, chunk_size - tokens)
+            while keep > 1 and overlap_tokens + window[keep-1][1] <= overlap_budget:
+                keep -= 1
+                overlap_tokens += window[keep][1]
+
+            yield Chunk(
+                text=' '.join(s for s, _ in window),
+                body=' '.join(s for s, _ in window[:keep]),
+                tokens=window_tokens
+                )
+            window = window[keep:]
+            window_tokens = overlap_tokens
+
+        window.append((sentence, tokens))
+        window_tokens += tokens
+
+    if window:
+        text = ' '.join(s for s, _ in window)
+        yield Chunk(text=text, body=text, tokens=window_tokens)
+
+
+# chunking strategies selectable per upload, chunk_size and overlap are in sentences or tokens
+CHUNKING_STRATEGIES = {
+    'sentences': iter_chunks,
+    'tokens': iter_token_chunks
+}
+
+
+def resolve_chunking(strategy=None, chunk_size=None, overlap=None) -> ChunkingParams:
+    '''
+    Fills in the configured defaults for the chunking options of an upload and validates them.
+    '''
+    strategy = strategy or CHUNKING_CONFIGS['default']
+    if strategy not in CHUNKING_STRATEGIES.keys():
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Unknown chunking strategy. Must be one of: {", ".join(CHUNKING_STRATEGIES.keys())}'
+            )
+
+    configs = CHUNKING_CONFIGS[strategy]
+    chunk_size = configs['chunk_size'] if chunk_size is None else chunk_size
+    overlap = configs['overlap'] if overlap is None else overlap
+
+    if chunk_size < 1 or chunk_size > configs['max_chunk_size'] or overlap < 0 or overlap >= chunk_size:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Invalid chunk size or overlap. chunk_size must be 1-{configs["max_chunk_size"]} and overlap less than chunk_size.'
+            )
+
+    return ChunkingParams(strategy=strategy, chunk_size=chunk_size, overlap=overlap)
+
+
+def chunk_stream(pieces, chunking: ChunkingParams):
+    return CHUNKING_STRATEGIES[chunking.strategy](pieces, chunk_size=chunking.chunk_size, overlap=chunking.overlap)
+
+
+class ChunkStats():
+    '''
+    Collects token statistics of the chunks of a document as they pass through.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total_tokens = 0
+        self.max_tokens = 0
+
+
+    def track(self, chunks):
+        for chunk in chunks:
+            tokens = chunk.tokens if chunk.tokens is not None else count_tokens(chunk.text)
+            self.count += 1
+            self.total_tokens += tokens
+            self.max_tokens = max(self.max_tokens, tokens)
+            metrics.observe('chunk_tokens', tokens)
+            yield chunk
+
+
+    def as_dict(self) -> dict:
+        avg = self.total_tokens / self.count if self.count else 0.0
+        return {'num_chunks': self.count, 'avg_chunk_tokens': avg, 'max_chunk_tokens': self.max_tokens}
 
 
 def strip_excerpt_overlap(s, overlap=3, start=True, end=False):
+    registry.ensure_punkt()
     sentences = sent_tokenize(s)
     startindex = 0 if start else 2
     endindex = len(sentences)-3 if not end else len(sentences)
@@ -42,44 +212,371 @@ def strip_excerpt_overlap(s, overlap=3, start=True, end=False):
 
 
 
-async def download_upload_file(file, path):
-    """
-    downloads the file completely to the given path.
-    """
+def max_upload_bytes() -> int:
+    return int(UPLOAD_CONFIGS['max_size_mb'] * 1024 * 1024)
+
+
+# room for the other form fields and the multipart framing on top of the file itself
+FORM_OVERHEAD_BYTES = 1024 * 1024
+
+
+def limit_request_size(max_bytes: int):
+    '''
+    Marks an endpoint whose requests ContentLengthRoute rejects when their Content-Length is over max_bytes.
+    '''
+    def mark(endpoint):
+        endpoint.max_request_bytes = max_bytes
+        return endpoint
+
+    return mark
+
+
+class ContentLengthRoute(APIRoute):
+    '''
+    Limits the size of requests to endpoints marked with limit_request_size before FastAPI
+    reads the form (which spools the whole body and happens before dependencies run).
+    A Content-Length over the limit is refused without receiving the body. The body is
+    also counted as it is received, so a request without a Content-Length (chunked) or
+    one that sends more than it declared is cut off once it passes the limit.
+    '''
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        max_bytes = getattr(self.endpoint, 'max_request_bytes', None)
+        if max_bytes is None:
+            return handler
+
+        def too_large():
+            metrics.incr('upload_rejected_size')
+            return HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f'File too large. Max upload size is {UPLOAD_CONFIGS["max_size_mb"]} MB.'
+                )
+
+        async def limited_handler(request: Request):
+            length = request.headers.get('content-length', '')
+            if length.isdigit() and int(length) > max_bytes:
+                raise too_large()
+
+            received = 0
+            async def limited_receive():
+                nonlocal received
+                message = await request.receive()
+                if message['type'] == 'http.request':
+                    received += len(message.get('body', b''))
+                    if received > max_bytes:
+                        raise too_large()
+
+                return message
+
+            return await handler(Request(request.scope, limited_receive))
+
+        return limited_handler
+
+
+def validate_upload(file, ext: str, allowed=FILE_SIGNATURES):
+    '''
+    Rejects an upload before any of it is read if the file type is not supported or
+    the size reported by the client is over the configured maximum.
+    The whole request has been received by now, see ContentLengthRoute for the check while receiving.
+    '''
+    if ext not in allowed.keys():
+        metrics.incr('upload_rejected_type')
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail='Unprocessable file type. Must be pdf, docx or txt.'
+            )
+
+    size = getattr(file, 'size', None)
+    if size is not None and size > max_upload_bytes():
+        metrics.incr('upload_rejected_size')
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f'File too large. Max upload size is {UPLOAD_CONFIGS["max_size_mb"]} MB.'
+            )
+
+
+async def iter_upload_chunks(file, ext: str):
+    '''
+    Reads the upload in fixed size chunks so the whole file is never held in memory.
+    Checks the file signature on the first chunk and stops as soon as the max size is passed.
+    '''
+    max_size = max_upload_bytes()
+    chunk_size = int(UPLOAD_CONFIGS['read_chunk_kb'] * 1024)
+    signatures = BATCH_SIGNATURES.get(ext)
+    total = 0
+
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+
+        if total == 0 and signatures and not chunk.startswith(signatures):
+            metrics.incr('upload_rejected_type')
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f'File contents do not match file type: {ext}'
+                )
+
+        total += len(chunk)
+        if total > max_size:
+            metrics.incr('upload_rejected_size')
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f'File too large. Max upload size is {UPLOAD_CONFIGS["max_size_mb"]} MB.'
+                )
+
+        yield chunk
+
+
+def record_upload_metrics(size: int, start: float):
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    mb_per_sec = size / (1024 * 1024) / elapsed
+
+    metrics.incr('upload_files')
+    metrics.incr('upload_bytes', size)
+    metrics.observe('upload_seconds', elapsed)
+    metrics.observe('upload_mb_per_sec', mb_per_sec)
+    logging.info(f'received upload of {size} bytes in {elapsed:.3f}s ({mb_per_sec:.2f} MB/s)')
+
+
+async def spool_upload_file(file, ext: str):
+    '''
+    Streams the upload into memory so it can be parsed without a disk round trip.
+    Uploads larger than upload.spool_threshold_mb spill over into a uniquely named temp file.
+
+    Returns the file bytes (or the temp file path if it was spilled to disk) and the
+    sha256 hex digest of the contents.
+    '''
+    threshold = int(UPLOAD_CONFIGS['spool_threshold_mb'] * 1024 * 1024)
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    sha = hashlib.sha256()
+    path, size = None, 0
+
     try:
-        with open(path, "wb") as buffer:
-            buffer.write(file.file.read())
-    
+        async for chunk in iter_upload_chunks(file, ext):
+            sha.update(chunk)
+            size += len(chunk)
+            if path is None and size > threshold:
+                os.makedirs(UPLOAD_CONFIGS['temp_dir'], exist_ok=True)
+                fd, path = tempfile.mkstemp(suffix=f'.{ext}', dir=UPLOAD_CONFIGS['temp_dir'])
+                spill = os.fdopen(fd, 'wb')
+                spill.write(buffer.getbuffer())
+                buffer = spill
+
+            buffer.write(chunk)
+
     except Exception as e:
+        buffer.close()
+        if path is not None:
+            os.remove(path)
+
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-    
 
-def pdf_reader(filepath: str):
-    extracted_text = []
-    doc = fitz.open(filepath)
-    for page in doc:
-        text = [line for line in re.split('\n{2,100}',page.get_text()) if len(re.split(r'.', line))>5]
-        extracted_text.extend(text)
-    
+    record_upload_metrics(size, start)
+    if path is not None:
+        buffer.close()
+        metrics.incr('upload_spooled_to_disk')
+        return path, sha.hexdigest()
 
-    return ' '.join(extracted_text)
+    return buffer.getvalue(), sha.hexdigest()
 
 
-def docx_reader(filepath: str):
-    doc = docx.Document(filepath)
-    text = []
-    for p in doc.paragraphs:
-        text.append(p.text)
+def release_upload_source(source):
+    '''
+    Removes the temp file behind a spooled upload. In memory uploads need no cleanup.
+    '''
+    if isinstance(source, str) and os.path.exists(source):
+        os.remove(source)
 
-    return '/n'.join(text)
 
-def txt_reader(filepath: str):
-    text = []
-    with open(filepath, 'r') as file:
-        for line in file.readlines():
-            text.append(line)
-    
-    return '\n'.join(text)
+def iter_source_blocks(source, block_size=1024*1024):
+    '''
+    Yields the raw bytes of an upload (bytes or a file path) in blocks.
+    '''
+    if isinstance(source, (bytes, bytearray)):
+        view = memoryview(source)
+        for i in range(0, len(view), block_size):
+            yield view[i: i+block_size]
+        return
+
+    with open(source, 'rb') as file:
+        while block := file.read(block_size):
+            yield block
+
+
+def read_source_head(source, size=8) -> bytes:
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source[:size])
+
+    with open(source, 'rb') as file:
+        return file.read(size)
+
+
+def open_pdf(source):
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype='pdf')
+
+    return fitz.open(source)
+
+
+class StreamProgress():
+    '''
+    How much of an input the text streams have consumed, in whatever unit suits the input
+    (pages, paragraphs, bytes or excerpts). Used to report job progress while ingesting.
+    '''
+    def __init__(self):
+        self.total = 0
+        self.position = 0
+
+
+    @property
+    def fraction(self) -> float:
+        return min(self.position / self.total, 1.0) if self.total > 0 else 0.0
+
+
+def filter_page_text(page_text: str) -> str:
+    text = [line for line in re.split('\n{2,100}', page_text) if len(re.split(r'.', line))>5]
+    return ' '.join(text)
+
+
+def extract_pdf_pages(source, start: int, end: int) -> list:
+    '''
+    Extracts the filtered text of pages [start, end). Runs inside the pdf worker processes.
+    '''
+    doc = open_pdf(source)
+    try:
+        return [filter_page_text(doc[i].get_text()) for i in range(start, end)]
+    finally:
+        doc.close()
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    global pdf_pool
+    with pdf_pool_lock:
+        if pdf_pool is None:
+            # spawned, not forked: the pool is created from a worker thread of a process that already
+            # runs executor, SQL pool and vector db threads whose locks a forked child could inherit held
+            pdf_pool = ProcessPoolExecutor(max_workers=INGEST_CONFIGS['pdf_workers'], mp_context=multiprocessing.get_context('spawn'))
+
+    return pdf_pool
+
+
+def shutdown_pdf_pool():
+    '''
+    Stops the pdf worker processes, if they were started.
+    '''
+    global pdf_pool
+    with pdf_pool_lock:
+        if pdf_pool is not None:
+            pdf_pool.shutdown(wait=False, cancel_futures=True)
+            pdf_pool = None
+
+
+def pdf_pages(source, progress=None):
+    '''
+    Yields the filtered text of each page in page order.
+    Large documents are split into page ranges that are extracted in parallel by the
+    pdf worker processes, small ones are read page by page in this process.
+    progress (a StreamProgress) is advanced by pages.
+    '''
+    progress = progress if progress else StreamProgress()
+    doc = open_pdf(source)
+    page_count = doc.page_count
+    progress.total = page_count
+    workers = INGEST_CONFIGS['pdf_workers']
+    pages_per_task = max(INGEST_CONFIGS['pdf_min_pages_per_task'], math.ceil(page_count / (workers * 4)))
+
+    if workers <= 1 or page_count <= pages_per_task:
+        try:
+            for page in doc:
+                text = filter_page_text(page.get_text())
+                progress.position += 1
+                if text:
+                    yield text
+        finally:
+            doc.close()
+        return
+
+    doc.close()
+    # in memory uploads are written to disk once so the tasks receive a path instead of a pickled copy each
+    spilled = None
+    if isinstance(source, (bytes, bytearray)):
+        os.makedirs(UPLOAD_CONFIGS['temp_dir'], exist_ok=True)
+        fd, spilled = tempfile.mkstemp(suffix='.pdf', dir=UPLOAD_CONFIGS['temp_dir'])
+        with os.fdopen(fd, 'wb') as spill:
+            spill.write(source)
+        source = spilled
+
+    futures = []
+    try:
+        pool = get_pdf_pool()
+        futures = [
+            pool.submit(extract_pdf_pages, source, start, min(start+pages_per_task, page_count))
+            for start in range(0, page_count, pages_per_task)
+            ]
+
+        for future in futures:
+            for text in future.result():
+                progress.position += 1
+                if text:
+                    yield text
+    finally:
+        for future in futures:
+            future.cancel()
+
+        if spilled is not None:
+            # running tasks still read the file
+            concurrent.futures.wait(futures)
+            release_upload_source(spilled)
+
+
+def docx_paragraphs(source, progress=None):
+    progress = progress if progress else StreamProgress()
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    doc = docx.Document(source)
+    paragraphs = doc.paragraphs
+    progress.total = len(paragraphs)
+    for p in paragraphs:
+        progress.position += 1
+        if p.text:
+            yield p.text
+
+
+def txt_blocks(source, progress=None):
+    '''
+    Yields the decoded text in blocks that end on a line break. progress is advanced by bytes.
+    '''
+    progress = progress if progress else StreamProgress()
+    progress.total = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+
+    # decode incrementally so multi-byte characters split across blocks are kept intact
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    for block in iter_source_blocks(source):
+        progress.position += len(block)
+        pending += decoder.decode(block)
+        cut = pending.rfind('\n') + 1
+        if cut:
+            yield pending[:cut]
+            pending = pending[cut:]
+
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+# generators of text pieces for each file type, consumed lazily by iter_chunks
+FILE_STREAMS = {
+    'pdf': pdf_pages,
+    'doc': docx_paragraphs,
+    'docx': docx_paragraphs,
+    'txt': txt_blocks
+}
 
 
 def create_new_doc(doc: Document) -> int:
@@ -98,32 +595,162 @@ def create_new_doc(doc: Document) -> int:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
-def save_excerpts_db(doc: Document) -> bool:
+DOCUMENT_CHUNKING_COLUMNS = 'chunk_strategy, chunk_size, chunk_overlap, num_chunks, avg_chunk_tokens, max_chunk_tokens'
+DOCUMENT_CHUNKING_PARAMS = ':chunk_strategy, :chunk_size, :chunk_overlap, :num_chunks, :avg_chunk_tokens, :max_chunk_tokens'
+
+
+def chunking_params(chunking: ChunkingParams, stats: dict) -> dict:
+    return dict(stats, chunk_strategy=chunking.strategy, chunk_size=chunking.chunk_size, chunk_overlap=chunking.overlap)
+
+
+def finish_document(docid: int, content_hash, chunking: ChunkingParams, stats: dict):
+    '''
+    Records how the document was chunked and the hash of the uploaded file once its excerpts
+    are saved. The hash makes the document available as a source for deduplicating later
+    uploads of the same file.
+    '''
+    db = database.db
+
+    try:
+        with db.connect() as conn:
+            query = text(
+                'UPDATE documents SET content_hash=:content_hash, chunk_strategy=:chunk_strategy, chunk_size=:chunk_size, '
+                'chunk_overlap=:chunk_overlap, num_chunks=:num_chunks, avg_chunk_tokens=:avg_chunk_tokens, '
+                'max_chunk_tokens=:max_chunk_tokens WHERE doc_id=:doc_id;'
+                )
+            conn.execute(query, dict(chunking_params(chunking, stats), content_hash=content_hash, doc_id=docid))
+            conn.commit()
+
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+def find_document_by_hash(content_hash: str, chunking: ChunkingParams):
     '''
-    Saves the excerpts to the database.
+    Finds a fully ingested document (of any user) with the same file contents that was
+    chunked the same way.
 
-    Returns if it was successful.
+    Returns the doc id or None.
+    '''
+    db = database.db
+
+    try:
+        with db.connect() as conn:
+            query = text(
+                'SELECT doc_id FROM documents WHERE content_hash=:content_hash AND chunk_strategy=:strategy '
+                'AND chunk_size=:chunk_size AND chunk_overlap=:overlap ORDER BY doc_id DESC LIMIT 1;'
+                )
+            row = conn.execute(query, dict(chunking.dict(), content_hash=content_hash)).fetchone()
+            return row[0] if row else None
+
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to fetch docs. error {e}')
+
+
+def iter_doc_excerpts(doc_id: int, progress=None):
+    '''
+    Streams the excerpts of a document in order as Chunks. progress is advanced by excerpts.
+    '''
+    progress = progress if progress else StreamProgress()
+    db = database.db
+
+    with db.connect() as conn:
+        query = text('SELECT COUNT(*) FROM excerpts WHERE doc_id=:doc_id;')
+        progress.total = conn.execute(query, dict(doc_id=doc_id)).scalar()
+
+        query = text('SELECT excerpt, body FROM excerpts WHERE doc_id=:doc_id ORDER BY excerpt_id ASC;')
+        result = conn.execution_options(stream_results=True).execute(query, dict(doc_id=doc_id))
+        for row in result:
+            progress.position += 1
+            yield Chunk(text=row[0], body=row[1])
+
+
+def insert_excerpts(conn, userid: int, docid: int, excerpts: list) -> list:
+    '''
+    Inserts a batch of excerpts (Chunks or plain strings) for a document with a single multi row INSERT,
+    reads back their ids with one indexed query and adds them to the user's lexical index in the
+    same transaction. Batches of a document must be inserted one after another.
+
+    Returns [{'excerpt_id', 'excerpt', 'excerpt_hash', 'term_count'}] for the inserted rows.
+    The caller adds them to the user's lexical_stats with add_lexical_stats before committing.
+    '''
+    chunks = [Chunk(text=exc) if isinstance(exc, str) else exc for exc in excerpts]
+    terms = [excerpt_terms(chunk.text) for chunk in chunks]
+    rows = [
+        {'excerpt': chunk.text, 'excerpt_hash': hash_text(chunk.text), 'term_count': sum(t.values())}
+        for chunk, t in zip(chunks, terms)
+        ]
+    params = {'doc_id': docid}
+    values = []
+    for i, (row, chunk) in enumerate(zip(rows, chunks)):
+        values.append(f'(:excerpt_{i}, :body_{i}, :excerpt_hash_{i}, :term_count_{i}, :doc_id)')
+        params[f'excerpt_{i}'] = row['excerpt']
+        params[f'body_{i}'] = chunk.body
+        params[f'excerpt_hash_{i}'] = row['excerpt_hash']
+        params[f'term_count_{i}'] = row['term_count']
+
+    query = text(f'INSERT INTO excerpts (excerpt, body, excerpt_hash, term_count, doc_id) VALUES {", ".join(values)};')
+    result = conn.execute(query, params)
+
+    # lastrowid is the first id of the batch, the others are not guaranteed to follow it one by one
+    # (auto_increment_increment > 1, innodb_autoinc_lock_mode=2) so they are read back in insert order
+    query = text('SELECT excerpt_id FROM excerpts WHERE doc_id=:doc_id AND excerpt_id >= :first_id ORDER BY excerpt_id ASC LIMIT :n;')
+    ids = [row[0] for row in conn.execute(query, dict(doc_id=docid, first_id=result.lastrowid, n=len(rows))).fetchall()]
+    if len(ids) != len(rows):
+        raise RuntimeError(f'Expected {len(rows)} new excerpt ids for doc {docid}, found {len(ids)}.')
+
+    for row, excerpt_id in zip(rows, ids):
+        row['excerpt_id'] = excerpt_id
+
+    index_excerpts(conn, userid, [{'excerpt_id': row['excerpt_id'], 'terms': t} for row, t in zip(rows, terms)])
+    return rows
+
+
+def iter_batches(items, batch_size: int):
+    items = iter(items)
+    while batch := list(itertools.islice(items, batch_size)):
+        yield batch
+
+
+def save_excerpts_db(doc: Document, excerpts=None, progress=None) -> int:
+    '''
+    Saves the excerpts to the database in batches of ingest.excerpt_batch_size and adds each
+    batch to the vectordb with the ids returned by the insert. excerpts can be any iterable
+    (e.g. iter_chunks) and is consumed lazily, defaulting to doc.excerpts.
+    progress is called with the number of excerpts saved so far after each batch.
+
+    Returns the number of excerpts saved.
     '''
     db = database.db
     if doc.docid is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='No doc id found for data.')
+
+    excerpts = doc.excerpts if excerpts is None else excerpts
+    count, total_terms = 0, 0
     try:
         with db.connect() as conn:
-            for exc in doc.excerpts:
-                query = text('INSERT INTO excerpts (excerpt, doc_id) VALUES(:excerpt, :doc_id);')
-                conn.execute(query, dict(excerpt=exc, doc_id=doc.docid))
-            
+            for batch in iter_batches(excerpts, INGEST_CONFIGS['excerpt_batch_size']):
+                rows = insert_excerpts(conn, doc.userid, doc.docid, batch)
+                registry.vectordb.add_file(doc.userid, doc.docid, rows)
+                count += len(rows)
+                total_terms += sum(row['term_count'] for row in rows)
+                if progress:
+                    progress(count)
+
+            # the user's stats row is shared by all their ingests, it is only locked right before the commit
+            add_lexical_stats(conn, doc.userid, count, total_terms)
             conn.commit()
-        
-        logging.info('adding to vectordb...')
-        vectordb.add_file(doc.userid, doc.docid, get_excerpts(doc.docid, doc.userid))
 
+        corpus_versions.bump(doc.userid)
 
     except Exception as e:
-        conn.close()
+        # the inserts are rolled back with the connection, the vectors have to be removed by hand
+        if count > 0:
+            registry.vectordb.delete(doc.userid, doc.docid)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
-            
-    return True
+
+    logging.info(f'saved {count} excerpts to db and vectordb for doc: {doc.docid}')
+    return count
 
 
 def get_user_files(userid: int) -> list:
@@ -138,7 +765,7 @@ def get_user_files(userid: int) -> list:
     
     try:
         with db.connect() as conn:
-            query = text('SELECT doc_id, title, upload_ts, descr FROM documents WHERE user_id=:user_id;')
+            query = text('SELECT doc_id, title, upload_ts, descr, chunk_strategy, num_chunks, avg_chunk_tokens FROM documents WHERE user_id=:user_id;')
             data = conn.execute(query, dict(user_id=userid))
             data = data.mappings().fetchall()
             return data
@@ -154,7 +781,7 @@ def get_excerpts(doc_id: int, user_id: int) -> list:
     
     try:
         with db.connect() as conn:
-            query = text('SELECT excerpt_id, excerpt FROM excerpts JOIN documents ON excerpts.doc_id=documents.doc_id WHERE excerpts.doc_id=:doc_id AND documents.user_id=:user_id ORDER BY excerpt_id ASC;')
+            query = text('SELECT excerpt_id, excerpt, body FROM excerpts JOIN documents ON excerpts.doc_id=documents.doc_id WHERE excerpts.doc_id=:doc_id AND documents.user_id=:user_id ORDER BY excerpt_id ASC;')
             data = conn.execute(query, dict(user_id=user_id,doc_id=doc_id))
             data = data.mappings().fetchall()
 
@@ -167,19 +794,33 @@ def get_excerpts(doc_id: int, user_id: int) -> list:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to fetch docs. error {e}')
 
 
+def excerpt_body(excerpt, last: bool) -> str:
+    '''
+    Returns the stored body of an excerpt, re-tokenizing only excerpts saved before bodies were stored.
+    '''
+    if excerpt['body'] is not None:
+        return excerpt['body']
+
+    return strip_excerpt_overlap(excerpt['excerpt'], end=last)
+
+
 def get_document(user_id: int, doc_id: int) -> str:
 
     if doc_id is None or type(doc_id) != int:
         return ''
+
+    cached = document_cache.get((user_id, doc_id))
+    if cached is not None:
+        return cached
     
     try:
         data = get_excerpts(doc_id, user_id)   
         if len(data) == 0:
             return ''
         
-        result = ''
-        for i, chunk in enumerate(data):
-            result += strip_excerpt_overlap(chunk['excerpt'], end=(i==len(data)-1))
+        result = ' '.join(excerpt_body(chunk, i==len(data)-1) for i, chunk in enumerate(data))
+        if len(result) <= CACHE_CONFIGS['documents']['max_chars']:
+            document_cache.set((user_id, doc_id), result)
         
         return result
     
@@ -187,30 +828,447 @@ def get_document(user_id: int, doc_id: int) -> str:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to fetch docs. error {e}')
 
 
+def iter_document_text(user_id: int, doc_id: int):
+    '''
+    Streams the reconstructed text of a document excerpt by excerpt using a server side
+    cursor, so memory stays flat no matter how large the document is.
+    '''
+    cached = document_cache.get((user_id, doc_id))
+    if cached is not None:
+        yield cached
+        return
+
+    db = database.db
+    try:
+        with db.connect() as conn:
+            query = text('SELECT excerpt, body FROM excerpts JOIN documents ON excerpts.doc_id=documents.doc_id WHERE excerpts.doc_id=:doc_id AND documents.user_id=:user_id ORDER BY excerpt_id ASC;')
+            result = conn.execution_options(stream_results=True).execute(query, dict(user_id=user_id, doc_id=doc_id))
+
+            # one row of lookahead, legacy excerpts need to know if they are the last one
+            previous, separator = None, ''
+            for row in result.mappings():
+                if previous is not None:
+                    yield separator + excerpt_body(previous, last=False)
+                    separator = ' '
+                previous = row
+
+            if previous is not None:
+                yield separator + excerpt_body(previous, last=True)
+
+    except Exception as e:
+        # the response has already started so the error can only be logged
+        logging.error(f'Failed to stream doc {doc_id} for user {user_id}. error {e}')
+
+
+def get_owned_doc_ids(userid: int, doc_ids: list) -> list:
+    '''
+    Filters doc_ids down to the documents owned by the user with one indexed query.
+    '''
+    db = database.db
+    doc_ids = sorted(set(int(d) for d in doc_ids))
+    if not doc_ids:
+        return []
+
+    try:
+        with db.connect() as conn:
+            query = text(f'SELECT doc_id FROM documents WHERE user_id=:user_id AND doc_id IN ({", ".join(str(d) for d in doc_ids)});')
+            data = conn.execute(query, dict(user_id=userid))
+            return [row[0] for row in data.fetchall()]
+
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to fetch docs. error {e}')
+
+
+def delete_files(userid: int, doc_ids: list) -> list:
+    '''
+    Deletes the given documents of the user with their excerpts, lexical index entries and the
+    cached embeddings no other excerpt uses in one transaction, then removes their vectors with
+    one batched delete. A failed vector delete is logged, the documents stay deleted.
+    Ids not owned by the user are ignored.
+
+    Returns the ids of the deleted documents.
+    '''
+    db = database.db
+    doc_ids = sorted(set(int(d) for d in doc_ids))
+    if not doc_ids:
+        return []
+
+    doc_list = ', '.join(str(d) for d in doc_ids)
+
+    try:
+        with db.connect() as conn:
+            # locks the rows so a concurrent delete of the same documents waits for this one
+            query = text(f'SELECT doc_id FROM documents WHERE user_id=:user_id AND doc_id IN ({doc_list}) FOR UPDATE;')
+            owned = [row[0] for row in conn.execute(query, dict(user_id=userid)).fetchall()]
+            if not owned:
+                conn.rollback()
+                return []
+
+            owned_list = ', '.join(str(d) for d in owned)
+            unindex_documents(conn, userid, owned)
+            prune_embeddings(conn, owned)
+            conn.execute(text(f'DELETE FROM excerpts WHERE doc_id IN ({owned_list});'))
+            conn.execute(text(f'DELETE FROM documents WHERE doc_id IN ({owned_list});'))
+            conn.commit()
+
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to delete documents. error {e}')
+
+    # the documents are gone once the transaction commits, whatever happens to their vectors
+    corpus_versions.bump(userid)
+    for doc_id in owned:
+        document_cache.pop((userid, doc_id))
+    metrics.incr('documents_deleted', len(owned))
+
+    try:
+        registry.vectordb.delete_many(userid, owned)
+
+    except Exception as e:
+        metrics.incr('vector_delete_failures')
+        logging.error(f'Failed to delete vectors of documents {owned}. error: {e}')
+
+    return owned
+
+
 def delete_file(userid: int, doc_id: int) -> bool:
     '''
     Deletes the given document from the database.
     '''
+    return len(delete_files(userid, [doc_id])) > 0
+
+
+def process_document(userid: int, filename: str, ext: str, description: str, source, progress=None, content_hash=None, chunking=None) -> tuple[int, int]:
+    '''
+    Runs the full ingest pipeline for an uploaded file: text extraction, chunking, saving
+    the document and excerpts and embedding them into the vector db.
+    If a document with the same content_hash was already ingested with the same chunking
+    its excerpts are copied instead of extracting the file again.
+    progress is called with (stage, fraction) when processing starts and after every saved batch
+    of excerpts, with the share of the file (pages, paragraphs or bytes) consumed so far.
+
+    Returns the new doc id and the number of excerpts saved.
+    '''
+    report = progress if progress else lambda stage, fraction: None
+    chunking = chunking if chunking else resolve_chunking()
+    stats = ChunkStats()
+    consumed = StreamProgress()
+
+    doc = Document(userid=userid, filename=filename, excerpts=[], description=description)
+    docid = create_new_doc(doc)
+    logging.info(f'created new doc: {docid}')
+
+    try:
+        existing_docid = find_document_by_hash(content_hash, chunking) if content_hash else None
+        report('processing', 0.1)
+
+        if existing_docid is not None:
+            logging.info(f'File already ingested as doc {existing_docid}, copying its excerpts.')
+            metrics.incr('ingest_dedup_hits')
+            chunks = iter_doc_excerpts(existing_docid, consumed)
+        else:
+            # extraction, chunking and saving run together as the chunks are consumed
+            logging.info(f'Extracting and chunking data from file: {filename} ({chunking.strategy})')
+            chunks = chunk_stream(FILE_STREAMS[ext](source, consumed), chunking)
+
+        def saved(count):
+            report('processing', 0.1 + 0.85 * consumed.fraction)
+
+        num_excerpts = save_excerpts_db(doc, stats.track(chunks), saved)
+        finish_document(docid, content_hash, chunking, stats.as_dict())
+
+    except Exception as e:
+        # don't leave a document without excerpts behind
+        try:
+            delete_file(userid, docid)
+        except HTTPException as cleanup_error:
+            logging.error(f'Failed to clean up doc {docid} after failed ingest. Error: {cleanup_error.detail}')
+        raise e
+
+    logging.info(f'Successfully saved excerpts for doc: {docid}')
+    return docid, num_excerpts
+
+
+TOO_MANY_FILES_ERROR = 'Too many files in batch.'
+
+
+def extract_archive_member(archive, info, ext: str):
+    '''
+    Reads a zip member into memory, or into a temp file if it is larger than upload.spool_threshold_mb.
+
+    Returns the source and the sha256 hex digest of the contents.
+    '''
+    threshold = int(UPLOAD_CONFIGS['spool_threshold_mb'] * 1024 * 1024)
+    sha = hashlib.sha256()
+    if info.file_size <= threshold:
+        with archive.open(info) as member:
+            source = member.read()
+        sha.update(source)
+        return source, sha.hexdigest()
+
+    os.makedirs(UPLOAD_CONFIGS['temp_dir'], exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=f'.{ext}', dir=UPLOAD_CONFIGS['temp_dir'])
+    try:
+        with os.fdopen(fd, 'wb') as spill, archive.open(info) as member:
+            while block := member.read(int(UPLOAD_CONFIGS['read_chunk_kb'] * 1024)):
+                sha.update(block)
+                spill.write(block)
+
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path, sha.hexdigest()
+
+
+def iter_archive_files(source, limit: int):
+    '''
+    Yields the supported files inside a zip archive as batch entries. Members over the max
+    upload size, of unsupported types, with the wrong signature or that can not be extracted
+    (e.g. encrypted or an unsupported compression method) are yielded as errors.
+    Members larger than upload.spool_threshold_mb are extracted to a temp file.
+    After limit entries the remaining members are yielded as errors without being extracted.
+    '''
+    archive = zipfile.ZipFile(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    count = 0
+
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+
+            filename = os.path.basename(info.filename)
+            ext = filename.split('.')[-1]
+            count += 1
+            if count > limit:
+                yield {'filename': filename, 'error': TOO_MANY_FILES_ERROR}
+                continue
+
+            if ext not in FILE_SIGNATURES.keys():
+                yield {'filename': filename, 'error': 'Unprocessable file type. Must be pdf, docx or txt.'}
+                continue
+
+            if info.file_size > max_upload_bytes():
+                yield {'filename': filename, 'error': f'File too large. Max upload size is {UPLOAD_CONFIGS["max_size_mb"]} MB.'}
+                continue
+
+            try:
+                member_source, content_hash = extract_archive_member(archive, info, ext)
+
+            except Exception as e:
+                yield {'filename': filename, 'error': f'Could not extract file from zip archive. error {e}'}
+                continue
+
+            signatures = FILE_SIGNATURES.get(ext)
+            if signatures and not read_source_head(member_source).startswith(signatures):
+                release_upload_source(member_source)
+                yield {'filename': filename, 'error': f'File contents do not match file type: {ext}'}
+                continue
+
+            yield {'filename': filename, 'ext': ext, 'source': member_source, 'content_hash': content_hash}
+
+
+async def iter_batch_files(files: list):
+    '''
+    Spools the files of a batch upload one at a time, expanding zip archives into their members.
+    Files that can not be read are yielded as errors instead of failing the whole batch, as are
+    the files past upload.max_batch_files, which are not read at all.
+    '''
+    count = 0
+    for file in files:
+        filename = file.filename
+        ext = filename.split('.')[-1]
+        remaining = UPLOAD_CONFIGS['max_batch_files'] - count
+
+        if remaining <= 0 and ext != 'zip':
+            count += 1
+            yield {'filename': filename, 'error': TOO_MANY_FILES_ERROR}
+            continue
+
+        try:
+            validate_upload(file, ext, allowed=BATCH_SIGNATURES)
+            source, content_hash = await spool_upload_file(file, ext)
+
+        except HTTPException as e:
+            count += 1
+            yield {'filename': filename, 'error': e.detail}
+            continue
+
+        if ext != 'zip':
+            count += 1
+            yield {'filename': filename, 'ext': ext, 'source': source, 'content_hash': content_hash}
+            continue
+
+        entries = iter_archive_files(source, remaining)
+        try:
+            # decompressing members and spilling them to disk runs on the io pool, one member at a time
+            while (entry := await run_blocking('io', next, entries, None)) is not None:
+                count += 1
+                yield entry
+
+        except zipfile.BadZipFile as e:
+            count += 1
+            yield {'filename': filename, 'error': f'Invalid zip archive. error {e}'}
+
+        finally:
+            entries.close()
+            release_upload_source(source)
+
+
+# form fields of a batch upload besides the files, anything past this is rejected by the form parser
+BATCH_FORM_MAX_FIELDS = 16
+
+
+def form_int(form, name: str):
+    value = form.get(name)
+    if value is None or value == '':
+        return None
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f'{name} must be an integer.')
+
+
+def parse_batch_form(form) -> tuple[list, str, ChunkingParams]:
+    '''
+    Reads the files, description and chunking options of a batch upload form.
+    The form is parsed by the route itself so it can allow upload.max_batch_files files
+    instead of the form parser's default of 1000.
+
+    Returns the uploaded files, the description and the resolved chunking.
+    '''
+    files = [f for f in form.getlist('files') if isinstance(f, StarletteUploadFile)]
+    if not files:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='No files uploaded.')
+
+    description = form.get('description')
+    description = "" if not isinstance(description, str) else description.strip()
+    chunking = form.get('chunking')
+    chunking = resolve_chunking(chunking or None, form_int(form, 'chunk_size'), form_int(form, 'chunk_overlap'))
+
+    return files, description, chunking
+
+
+def prepare_document(ext: str, source, content_hash, chunking: ChunkingParams) -> tuple[list, dict]:
+    '''
+    Extracts and chunks a file for a batch upload, copying the excerpts of an already ingested
+    copy of the same file when there is one. Releases the upload source.
+
+    Returns the list of excerpts and their chunk statistics.
+    '''
+    stats = ChunkStats()
+    try:
+        existing_docid = find_document_by_hash(content_hash, chunking) if content_hash else None
+        if existing_docid is not None:
+            metrics.incr('ingest_dedup_hits')
+            chunks = iter_doc_excerpts(existing_docid)
+        else:
+            chunks = chunk_stream(FILE_STREAMS[ext](source), chunking)
+
+        return list(stats.track(chunks)), stats.as_dict()
+
+    finally:
+        release_upload_source(source)
+
+
+def save_documents_batch(userid: int, docs: list, chunking: ChunkingParams) -> list:
+    '''
+    Saves a group of prepared documents with all their excerpts in a single transaction,
+    then adds the excerpts to the vectordb in batches of ingest.embed_batch_size.
+    docs is [{'filename', 'description', 'excerpts', 'stats', 'content_hash'}].
+
+    Returns the new doc ids in the same order as docs.
+    '''
     db = database.db
+    docids, rows = [], []
 
     try:
         with db.connect() as conn:
-            query1 = text('DELETE FROM excerpts WHERE doc_id=:doc_id;')
-            conn.execute(query1, dict(doc_id=doc_id))
-            query2 = text('DELETE FROM documents WHERE doc_id=:doc_id;')
-            data = conn.execute(query2, dict(doc_id=doc_id))
-            conn.commit()
+            for doc in docs:
+                query = text(
+                    f'INSERT INTO documents (title, user_id, descr, content_hash, {DOCUMENT_CHUNKING_COLUMNS}) '
+                    f'VALUES(:title, :user_id, :descr, :content_hash, {DOCUMENT_CHUNKING_PARAMS});'
+                    )
+                params = dict(title=doc['filename'], user_id=userid, descr=doc['description'], content_hash=doc['content_hash'])
+                result = conn.execute(query, dict(chunking_params(chunking, doc['stats']), **params))
+                docid = result.lastrowid
+                docids.append(docid)
 
-        vectordb.delete(userid, doc_id)
+                for batch in iter_batches(doc['excerpts'], INGEST_CONFIGS['excerpt_batch_size']):
+                    rows.extend(dict(row, doc_id=docid) for row in insert_excerpts(conn, userid, docid, batch))
+
+            for batch in iter_batches(rows, INGEST_CONFIGS['embed_batch_size']):
+                registry.vectordb.add_excerpts(userid, batch)
+
+            # the user's stats row is shared by all their ingests, it is only locked right before the commit
+            add_lexical_stats(conn, userid, len(rows), sum(row['term_count'] for row in rows))
+            conn.commit()
 
-        return data.rowcount > 0
+        corpus_versions.bump(userid)
 
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to delete document. error {e}')
+        for docid in docids:
+            registry.vectordb.delete(userid, docid)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
-    
-    
+    logging.info(f'saved {len(docs)} documents with {len(rows)} excerpts for user {userid}')
+    return docids
+
+
+async def process_document_batch(userid: int, files: list, description: str, chunking: ChunkingParams) -> list:
+    '''
+    Ingests the files of a batch upload in groups of ingest.batch_group_size. Files in a group
+    are extracted and chunked concurrently and each group is saved in one transaction.
+
+    Returns a result per file: {'filename', 'doc_id', 'excerpts'} or {'filename', 'error'}.
+    '''
+    results = []
+    limit = asyncio.Semaphore(INGEST_CONFIGS['batch_workers'])
+
+    async def prepare(entry):
+        async with limit:
+            try:
+                entry['excerpts'], entry['stats'] = await run_blocking(
+                    'cpu', prepare_document, entry['ext'], entry['source'], entry['content_hash'], chunking
+                    )
+            except Exception as e:
+                entry['error'] = e.detail if isinstance(e, HTTPException) else str(e)
+
+    async def save_group(group):
+        await asyncio.gather(*(prepare(entry) for entry in group))
+        prepared = [dict(entry, description=description) for entry in group if 'error' not in entry]
+
+        try:
+            docids = await run_blocking('sql', save_documents_batch, userid, prepared, chunking) if prepared else []
+            for entry, docid in zip(prepared, docids):
+                results.append({'filename': entry['filename'], 'doc_id': docid, 'excerpts': len(entry['excerpts'])})
+
+        except HTTPException as e:
+            results.extend({'filename': entry['filename'], 'error': e.detail} for entry in prepared)
+
+        results.extend({'filename': entry['filename'], 'error': entry['error']} for entry in group if 'error' in entry)
+
+    group, count = [], 0
+    try:
+        async for entry in iter_batch_files(files):
+            count += 1
+            if 'error' in entry:
+                results.append(entry)
+                continue
 
+            group.append(entry)
+            if len(group) >= INGEST_CONFIGS['batch_group_size']:
+                await save_group(group)
+                group = []
 
+        if group:
+            await save_group(group)
+            group = []
 
+    finally:
+        # files of a group that was never prepared still hold their temp files
+        for entry in group:
+            release_upload_source(entry.get('source'))
 
+    metrics.incr('batch_upload_files', count)
+    return results
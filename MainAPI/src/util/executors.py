@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
+from util.util import read_configs
+from util.metrics import metrics
+
+
+logging.basicConfig(level=logging.INFO)
+EXECUTOR_CONFIGS = read_configs(filename='config.json')['executors']
+
+
+class BlockingExecutors():
+    '''
+    A bounded thread pool per kind of blocking work (sql, vector, cpu, io) so async routes never
+    block the event loop and one slow resource cannot take the threads of the others.
+    Each kind also caps its pending calls; over the cap calls are rejected with a 503.
+    Queue depth is kept as the executor_{kind}_pending gauge and the time calls wait for a
+    thread is observed as executor_{kind}_wait_seconds.
+    '''
+    def __init__(self, configs: dict):
+        self.configs = configs
+        self.__pools = {}
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+
+    def pool(self, kind: str) -> ThreadPoolExecutor:
+        with self.__lock:
+            if kind not in self.__pools:
+                self.__pools[kind] = ThreadPoolExecutor(max_workers=self.configs[kind]['workers'], thread_name_prefix=f'{kind}-worker')
+
+            return self.__pools[kind]
+
+
+    def __track(self, kind: str, change: int) -> int:
+        with self.__lock:
+            pending = self.__pending.get(kind, 0) + change
+            self.__pending[kind] = pending
+
+        metrics.set(f'executor_{kind}_pending', pending)
+        return pending
+
+
+    async def run(self, kind: str, fn, *args, **kwargs):
+        '''
+        Runs fn(*args, **kwargs) on the pool for kind and waits for the result without blocking the loop.
+        '''
+        pool = self.pool(kind)
+        if self.__track(kind, 1) > self.configs[kind]['max_pending']:
+            self.__track(kind, -1)
+            metrics.incr(f'executor_{kind}_rejected')
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='The server is busy. Try again shortly.',
+                headers={'Retry-After': '1'}
+                )
+
+        submitted = time.perf_counter()
+
+        def call():
+            metrics.observe(f'executor_{kind}_wait_seconds', time.perf_counter() - submitted)
+            return fn(*args, **kwargs)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+        finally:
+            self.__track(kind, -1)
+
+
+    def shutdown(self):
+        with self.__lock:
+            for pool in self.__pools.values():
+                pool.shutdown(wait=False)
+            self.__pools.clear()
+
+
+executors = BlockingExecutors(EXECUTOR_CONFIGS)
+
+
+async def run_blocking(kind: str, fn, *args, **kwargs):
+    return await executors.run(kind, fn, *args, **kwargs)
@@ -1,41 +1,80 @@
-import openai 
+import openai
+import httpx
 from util.openai import APIKEY
+from util.util import read_configs
 import logging
 
 
 logging.basicConfig(level=logging.INFO)
-client = openai.OpenAI(api_key=APIKEY)
+OPENAI_CONFIGS = read_configs(filename='config.json')['openai']
 
-def call_gpt(msg, excerpts):
+client = None
+
+
+def get_client() -> openai.AsyncOpenAI:
     '''
-    Calls the OpenAI API and fetches a response from chatGPT 3.5 turbo.
-    
-    Returns the message response string from chatGPT
+    Returns the shared async client. Its httpx connection pool is created on first use so it
+    belongs to the server's event loop and keeps connections to the API alive between requests.
     '''
+    global client
+    if client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_CONFIGS['max_connections'],
+                max_keepalive_connections=OPENAI_CONFIGS['max_keepalive_connections']
+                ),
+            timeout=httpx.Timeout(OPENAI_CONFIGS['timeout_seconds'], connect=5.0)
+            )
+        client = openai.AsyncOpenAI(api_key=APIKEY, http_client=http_client)
+
+    return client
 
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.close()
+        client = None
+
+
+def build_messages(msg, excerpts) -> list:
     context = ' '.join(excerpts)
+    return [
+        {'role': 'system', 'content': f'Using only this information, answer the user\'s question: {context}'},
+        {'role': 'user', 'content': msg}
+    ]
+
 
+async def call_gpt(msg, excerpts):
+    '''
+    Calls the OpenAI API and fetches a response from chatGPT 3.5 turbo.
+
+    Returns the message response string from chatGPT
+    '''
     try:
-        output = client.chat.completions.create(
-            model='gpt-3.5-turbo',
-            messages=[
-                {'role': 'system', 'content': f'Using only this information, answer the user\'s question: {context}'},
-                {'role': 'user', 'content': msg}
-            ]
+        output = await get_client().chat.completions.create(
+            model=OPENAI_CONFIGS['model'],
+            messages=build_messages(msg, excerpts)
         )
 
         return output.choices[0].message.content
-    
+
     except Exception as e:
         logging.error(f'Failed to query chatGPT. Error: {e}')
         return None
 
 
-def get_embeddings(s:str) -> list:
-    client.embeddings.create(s)
-
+async def stream_gpt(msg, excerpts):
+    '''
+    Calls the OpenAI API with streaming and yields the pieces of the response as they arrive.
+    Errors are raised to the caller, which has already started its response.
+    '''
+    stream = await get_client().chat.completions.create(
+        model=OPENAI_CONFIGS['model'],
+        messages=build_messages(msg, excerpts),
+        stream=True
+    )
 
-if __name__ == '__main__':
-    # print(APIKEY)
-    msg = 'write me a haiku.'
-    print(call_gpt(msg))
\ No newline at end of file
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
@@ -0,0 +1,205 @@
+import queue
+import threading
+import logging
+import uuid
+from typing import Any, Optional
+from pydantic import BaseModel
+from fastapi import HTTPException, status
+from sqlalchemy import text
+from util.util import read_configs
+from util.metrics import metrics
+from util.docprocessing import database, process_document, release_upload_source
+from util.modelparams import ChunkingParams
+
+
+logging.basicConfig(level=logging.INFO)
+INGEST_CONFIGS = read_configs(filename='config.json')['ingest']
+
+JOB_COLUMNS = ['status', 'stage', 'progress', 'doc_id', 'num_excerpts', 'error']
+
+
+class IngestJob(BaseModel):
+    job_id: str
+    userid: int
+    filename: str
+    ext: str
+    description: str
+    source: Any
+    content_hash: Optional[str] = None
+    chunking: Optional[ChunkingParams] = None
+
+
+def create_job(job: IngestJob):
+    db = database.db
+
+    try:
+        with db.connect() as conn:
+            query = text('INSERT INTO ingest_jobs (job_id, user_id, filename) VALUES(:job_id, :user_id, :filename);')
+            conn.execute(query, dict(job_id=job.job_id, user_id=job.userid, filename=job.filename))
+            conn.commit()
+
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to create ingest job. error {e}')
+
+
+def update_job(job_id: str, **fields):
+    '''
+    Persists status/progress changes for a job. Failures are only logged so a status
+    write can never break the ingest itself.
+    '''
+    fields = {k: v for k, v in fields.items() if k in JOB_COLUMNS}
+    if not fields:
+        return
+
+    db = database.db
+    assignments = ', '.join(f'{k}=:{k}' for k in fields.keys())
+
+    try:
+        with db.connect() as conn:
+            query = text(f'UPDATE ingest_jobs SET {assignments} WHERE job_id=:job_id;')
+            conn.execute(query, dict(fields, job_id=job_id))
+            conn.commit()
+
+    except Exception as e:
+        logging.error(f'Failed to update ingest job {job_id}. error: {e}')
+
+
+def delete_job(job_id: str):
+    db = database.db
+
+    try:
+        with db.connect() as conn:
+            conn.execute(text('DELETE FROM ingest_jobs WHERE job_id=:job_id;'), dict(job_id=job_id))
+            conn.commit()
+
+    except Exception as e:
+        logging.error(f'Failed to delete ingest job {job_id}. error: {e}')
+
+
+def fail_interrupted_jobs():
+    '''
+    Marks the jobs left queued or running by a previous run of the server as failed. The queue
+    only lives in memory, so nothing will ever pick those jobs up again.
+    Failures are only logged so the server still starts.
+    '''
+    db = database.db
+
+    try:
+        with db.connect() as conn:
+            query = text("UPDATE ingest_jobs SET status='failed', error=:error WHERE status IN ('queued', 'running');")
+            result = conn.execute(query, dict(error='interrupted'))
+            conn.commit()
+
+        if result.rowcount:
+            logging.info(f'marked {result.rowcount} interrupted ingest jobs as failed')
+            metrics.incr('ingest_jobs_failed', result.rowcount)
+
+    except Exception as e:
+        logging.error(f'Failed to mark interrupted ingest jobs. error: {e}')
+
+
+def get_job(userid: int, job_id: str):
+    '''
+    Fetches the status of an ingest job owned by the user.
+
+    Returns None if the job does not exist for the user.
+    '''
+    db = database.db
+
+    try:
+        with db.connect() as conn:
+            query = text('SELECT job_id, filename, status, stage, progress, doc_id, num_excerpts, error, created_ts, updated_ts FROM ingest_jobs WHERE job_id=:job_id AND user_id=:user_id;')
+            data = conn.execute(query, dict(job_id=job_id, user_id=userid))
+            return data.mappings().fetchone()
+
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Failed to fetch job. error {e}')
+
+
+def run_job(job: IngestJob):
+    def progress(stage, fraction):
+        update_job(job.job_id, status='running', stage=stage, progress=fraction)
+
+    try:
+        docid, num_excerpts = process_document(job.userid, job.filename, job.ext, job.description, job.source, progress, job.content_hash, job.chunking)
+        update_job(job.job_id, status='done', stage='done', progress=1.0, doc_id=docid, num_excerpts=num_excerpts)
+        metrics.incr('ingest_jobs_done')
+
+    except Exception as e:
+        error = e.detail if isinstance(e, HTTPException) else str(e)
+        logging.error(f'Ingest job {job.job_id} failed. error: {error}')
+        update_job(job.job_id, status='failed', error=error)
+        metrics.incr('ingest_jobs_failed')
+
+    finally:
+        release_upload_source(job.source)
+
+
+class IngestQueue():
+    '''
+    Bounded queue of ingest jobs processed by a fixed pool of worker threads.
+    Submitting to a full queue is rejected so uploads back off instead of piling up in memory.
+    '''
+    def __init__(self, workers: int, maxsize: int):
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__workers = workers
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+
+    def start(self):
+        with self.__lock:
+            if self.__threads:
+                return
+
+            for i in range(self.__workers):
+                thread = threading.Thread(target=self.__work, name=f'ingest-worker-{i}', daemon=True)
+                thread.start()
+                self.__threads.append(thread)
+
+
+    def __work(self):
+        while True:
+            job = self.__queue.get()
+            try:
+                run_job(job)
+            finally:
+                self.__queue.task_done()
+
+
+    @property
+    def depth(self) -> int:
+        return self.__queue.qsize()
+
+
+    def submit(self, userid: int, filename: str, ext: str, description: str, source, content_hash=None, chunking=None) -> str:
+        '''
+        Queues an uploaded file for ingestion.
+
+        Returns the job id.
+        '''
+        self.start()
+        job = IngestJob(
+            job_id=str(uuid.uuid4()), userid=userid, filename=filename, ext=ext,
+            description=description, source=source, content_hash=content_hash, chunking=chunking
+            )
+        create_job(job)
+
+        try:
+            self.__queue.put_nowait(job)
+
+        except queue.Full:
+            delete_job(job.job_id)
+            release_upload_source(source)
+            metrics.incr('ingest_jobs_rejected')
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Too many documents are being processed. Try again shortly.',
+                headers={'Retry-After': str(INGEST_CONFIGS['retry_after_seconds'])}
+                )
+
+        metrics.incr('ingest_jobs_queued')
+        return job.job_id
+
+
+ingest_queue = IngestQueue(INGEST_CONFIGS['workers'], INGEST_CONFIGS['queue_size'])
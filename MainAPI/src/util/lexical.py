@@ -0,0 +1,212 @@
+import re
+import math
+import logging
+from collections import Counter
+from sqlalchemy import text
+from util.util import read_configs
+from util.resources import registry
+
+
+logging.basicConfig(level=logging.INFO)
+RETRIEVAL_CONFIGS = read_configs(filename='config.json')['retrieval']
+
+# identifiers keep their inner punctuation (e.g. 'iso-9001', 'sec.4.2.1'), their parts are indexed too
+TERM_PATTERN = re.compile(r'[a-z0-9]+(?:[-_./:][a-z0-9]+)*')
+MAX_TERM_LENGTH = 64
+TERM_INSERT_BATCH_SIZE = 5000
+
+# skipped in queries, they match nearly every excerpt and say nothing about relevance
+STOP_WORDS = frozenset('''
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself yourselves
+'''.split())
+
+
+def tokenize_terms(s: str) -> list:
+    '''
+    Splits text into lower cased index terms. Compound identifiers yield the whole
+    identifier followed by each of its alphanumeric parts.
+    '''
+    terms = []
+    for match in TERM_PATTERN.findall(s.lower()):
+        terms.append(match[:MAX_TERM_LENGTH])
+        parts = re.split(r'[-_./:]', match)
+        if len(parts) > 1:
+            terms.extend(part[:MAX_TERM_LENGTH] for part in parts)
+
+    return terms
+
+
+def excerpt_terms(s: str) -> Counter:
+    return Counter(tokenize_terms(s))
+
+
+def index_excerpts(conn, userid: int, rows: list):
+    '''
+    Adds inserted excerpts to the user's inverted index inside the caller's transaction.
+    rows are [{'excerpt_id', 'terms'}] where terms is the Counter of the excerpt's terms.
+    The user's totals are not touched, see add_lexical_stats.
+    '''
+    params, values = {'user_id': userid}, []
+    for row in rows:
+        for term, tf in row['terms'].items():
+            i = len(values)
+            values.append(f'(:term_{i}, :excerpt_id_{i}, :user_id, :tf_{i})')
+            params[f'term_{i}'] = term
+            params[f'excerpt_id_{i}'] = row['excerpt_id']
+            params[f'tf_{i}'] = tf
+
+    # split so a batch of long excerpts does not turn into one huge statement
+    for start in range(0, len(values), TERM_INSERT_BATCH_SIZE):
+        batch = values[start: start+TERM_INSERT_BATCH_SIZE]
+        conn.execute(text(f'INSERT INTO excerpt_terms (term, excerpt_id, user_id, tf) VALUES {", ".join(batch)};'), params)
+
+
+def add_lexical_stats(conn, userid: int, num_excerpts: int, total_terms: int):
+    '''
+    Adds indexed excerpts to the user's BM25 totals. This locks the user's lexical_stats row until
+    the transaction ends, so it should be the last write before the commit of a long ingest.
+    '''
+    if num_excerpts == 0:
+        return
+
+    query = text(
+        'INSERT INTO lexical_stats (user_id, num_excerpts, total_terms) VALUES(:user_id, :num_excerpts, :total_terms) '
+        'ON DUPLICATE KEY UPDATE num_excerpts=num_excerpts+VALUES(num_excerpts), total_terms=total_terms+VALUES(total_terms);'
+        )
+    conn.execute(query, dict(user_id=userid, num_excerpts=num_excerpts, total_terms=total_terms))
+
+
+def unindex_documents(conn, userid: int, doc_ids: list):
+    '''
+    Removes the documents' excerpts from the user's inverted index. Must run before the excerpts are deleted.
+    '''
+    doc_list = ', '.join(str(int(d)) for d in doc_ids)
+    query = text(
+        'UPDATE lexical_stats, (SELECT COUNT(*) AS num_excerpts, COALESCE(SUM(term_count), 0) AS total_terms '
+        f'FROM excerpts WHERE doc_id IN ({doc_list}) AND term_count IS NOT NULL) AS removed '
+        'SET lexical_stats.num_excerpts=lexical_stats.num_excerpts-removed.num_excerpts, '
+        'lexical_stats.total_terms=lexical_stats.total_terms-removed.total_terms '
+        'WHERE lexical_stats.user_id=:user_id;'
+        )
+    conn.execute(query, dict(user_id=userid))
+
+    query = text(f'DELETE excerpt_terms FROM excerpt_terms JOIN excerpts ON excerpt_terms.excerpt_id=excerpts.excerpt_id WHERE excerpts.doc_id IN ({doc_list});')
+    conn.execute(query)
+
+
+def query_terms(query: str) -> list:
+    '''
+    Distinct terms of a query without stop words, capped at retrieval.max_query_terms.
+    '''
+    terms = [term for term in dict.fromkeys(tokenize_terms(query)) if term not in STOP_WORDS]
+    return terms[:RETRIEVAL_CONFIGS['max_query_terms']]
+
+
+def bm25_search(query: str, userid: int, n_results: int, doc_ids=None) -> list:
+    '''
+    Scores the user's excerpts against the query terms with BM25 using the inverted index,
+    only considering the documents in doc_ids if given. Term statistics stay user wide.
+    Stop words and terms with an idf below retrieval.min_idf (found in most excerpts) are
+    not scored.
+
+    Returns [{'id', 'doc_id', 'score', 'text'}] best first. score is normalized by the sum
+    of the idf of every scored query term, so an average length excerpt containing each of
+    them once scores 1.0.
+    '''
+    terms = query_terms(query)
+    if not terms:
+        return []
+
+    k1, b = RETRIEVAL_CONFIGS['bm25_k1'], RETRIEVAL_CONFIGS['bm25_b']
+    db = registry.database.db
+
+    with db.connect() as conn:
+        stats = conn.execute(
+            text('SELECT num_excerpts, total_terms FROM lexical_stats WHERE user_id=:user_id;'), dict(user_id=userid)
+            ).fetchone()
+        if stats is None or stats[0] <= 0:
+            return []
+
+        num_excerpts, avg_length = stats[0], max(stats[1] / stats[0], 1.0)
+
+        term_params = {f'term_{i}': term for i, term in enumerate(terms)}
+        term_list = ', '.join(f':term_{i}' for i in range(len(terms)))
+        query = text(f'SELECT term, COUNT(*) FROM excerpt_terms WHERE user_id=:user_id AND term IN ({term_list}) GROUP BY term;')
+        frequencies = dict(conn.execute(query, dict(term_params, user_id=userid)).fetchall())
+
+        idfs = {}
+        for term in terms:
+            df = frequencies.get(term, 0)
+            idf = math.log(1 + (num_excerpts - df + 0.5) / (df + 0.5))
+            if idf >= RETRIEVAL_CONFIGS['min_idf']:
+                idfs[term] = idf
+
+        # terms missing from the index still count towards the normalization, an excerpt
+        # has to match a good share of what the query asks about
+        max_score = sum(idfs.values())
+        terms = [term for term in idfs.keys() if term in frequencies]
+        if not terms:
+            return []
+
+        # idf is computed here and passed in, the database only sums the per term scores
+        term_params = {f'term_{i}': term for i, term in enumerate(terms)}
+        term_list = ', '.join(f':term_{i}' for i in range(len(terms)))
+        params = dict(term_params, user_id=userid, k1=k1, b=b, avg_length=avg_length, n_results=n_results)
+        doc_filter = ''
+        if doc_ids:
+            doc_filter = f'AND excerpts.doc_id IN ({", ".join(str(int(d)) for d in doc_ids)}) '
+        cases = []
+        for i, term in enumerate(terms):
+            params[f'idf_{i}'] = idfs[term]
+            cases.append(f'WHEN :term_{i} THEN :idf_{i}')
+
+        query = text(
+            f'SELECT excerpt_terms.excerpt_id, SUM((CASE excerpt_terms.term {" ".join(cases)} ELSE 0 END) '
+            '* excerpt_terms.tf * (:k1 + 1) / (excerpt_terms.tf + :k1 * (1 - :b + :b * excerpts.term_count / :avg_length))) AS score '
+            'FROM excerpt_terms JOIN excerpts ON excerpt_terms.excerpt_id=excerpts.excerpt_id '
+            f'WHERE excerpt_terms.user_id=:user_id AND excerpt_terms.term IN ({term_list}) {doc_filter}'
+            'GROUP BY excerpt_terms.excerpt_id ORDER BY score DESC LIMIT :n_results;'
+            )
+        scores = conn.execute(query, params).fetchall()
+        if not scores:
+            return []
+
+        id_list = ', '.join(str(int(row[0])) for row in scores)
+        query = text(f'SELECT excerpt_id, excerpt, doc_id FROM excerpts WHERE excerpt_id IN ({id_list});')
+        excerpts = {row[0]: row for row in conn.execute(query).fetchall()}
+
+    return [
+        {'id': str(row[0]), 'doc_id': excerpts[row[0]][2], 'score': float(row[1]) / max_score, 'text': excerpts[row[0]][1]}
+        for row in scores if row[0] in excerpts
+        ]
+
+
+def fuse_results(vector_results: list, lexical_results: list, n_results: int) -> list:
+    '''
+    Merges vector and BM25 results with reciprocal rank fusion. vector_results must already be
+    within the distance threshold. A BM25 hit below retrieval.min_lexical_score only adds to the
+    rank of an excerpt the vector search found, it is never returned on its own.
+
+    Returns [{'id', 'doc_id', 'distance', 'text', 'score'}] best first. distance is None for excerpts only found lexically.
+    '''
+    rrf_k = RETRIEVAL_CONFIGS['rrf_k']
+    vector_ids = set(excerpt['id'] for excerpt in vector_results)
+    fused = {}
+    for results in (vector_results, lexical_results):
+        for rank, excerpt in enumerate(results):
+            if excerpt['id'] not in vector_ids and excerpt['score'] < RETRIEVAL_CONFIGS['min_lexical_score']:
+                continue
+
+            entry = fused.setdefault(
+                excerpt['id'], {'id': excerpt['id'], 'doc_id': excerpt['doc_id'], 'distance': None, 'text': excerpt['text'], 'score': 0.0}
+                )
+            entry['score'] += 1 / (rrf_k + rank + 1)
+            if 'distance' in excerpt:
+                entry['distance'] = excerpt['distance']
+
+    return sorted(fused.values(), key=lambda e: e['score'], reverse=True)[:n_results]
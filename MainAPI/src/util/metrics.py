@@ -0,0 +1,53 @@
+import threading
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class Metrics():
+    '''
+    Small thread safe store of counters and timing observations exposed through /metrics.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__observations = {}
+
+
+    def incr(self, name: str, value=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+
+    def set(self, name: str, value: float):
+        '''
+        Sets a gauge to its current value (e.g. a queue depth).
+        '''
+        with self.__lock:
+            self.__gauges[name] = value
+
+
+    def observe(self, name: str, value: float):
+        '''
+        Records a single observation (e.g. a duration or a rate) and keeps count, total and max.
+        '''
+        with self.__lock:
+            obs = self.__observations.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+            obs['count'] += 1
+            obs['total'] += value
+            obs['max'] = max(obs['max'], value)
+
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            observations = {}
+            for name, obs in self.__observations.items():
+                avg = obs['total'] / obs['count'] if obs['count'] else 0.0
+                observations[name] = dict(obs, avg=avg)
+
+            return {'counters': dict(self.__counters), 'gauges': dict(self.__gauges), 'observations': observations}
+
+
+metrics = Metrics()
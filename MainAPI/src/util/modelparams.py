@@ -30,6 +30,25 @@ class Token(BaseModel):
     token_type: str
 
 
+class Chunk(BaseModel):
+    text: str
+    # the part of text not repeated at the start of the next chunk, None for legacy excerpts
+    body: Optional[str] = None
+    tokens: Optional[int] = None
+
+
+class ChunkingParams(BaseModel):
+    strategy: str
+    chunk_size: int
+    overlap: int
+
+
+class RetrievalParams(BaseModel):
+    top_k: int
+    threshold: float
+    doc_ids: Optional[list[int]] = None
+
+
 class Document(BaseModel):
     userid: int
     filename: str
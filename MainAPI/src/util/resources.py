@@ -0,0 +1,114 @@
+import threading
+import logging
+import nltk
+from sqlalchemy import text
+from util.db import MySQLDatabase, VectorDB
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class ResourceRegistry():
+    '''
+    Shared resources created at most once per process, the first time they are used:
+    the NLTK sentence model, the SQL engine and the vector db.
+    warm_up() creates all of them up front so the first request does not pay for it.
+    '''
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__database = None
+        self.__vectordb = None
+        self.__punkt_ready = False
+        self.__warm_up_hooks = {}
+        self.__warm = False
+
+
+    @property
+    def database(self) -> MySQLDatabase:
+        with self.__lock:
+            if self.__database is None:
+                self.__database = MySQLDatabase()
+
+            return self.__database
+
+
+    @property
+    def vectordb(self) -> VectorDB:
+        with self.__lock:
+            if self.__vectordb is None:
+                logging.info('opening vectordb...')
+                self.__vectordb = VectorDB(self.database)
+
+            return self.__vectordb
+
+
+    def ensure_punkt(self):
+        if self.__punkt_ready:
+            return
+
+        with self.__lock:
+            if self.__punkt_ready:
+                return
+
+            try:
+                nltk.data.find('tokenizers/punkt')
+            except LookupError:
+                nltk.download('punkt', quiet=True)
+
+            self.__punkt_ready = True
+
+
+    def register_warm_up(self, name: str, hook):
+        '''
+        Registers an extra function to run during warm_up, e.g. loading a tokenizer.
+        '''
+        self.__warm_up_hooks[name] = hook
+
+
+    def warm_up(self) -> dict:
+        '''
+        Creates every shared resource and runs the registered warm up hooks.
+
+        Returns {name: error or None} for each step.
+        '''
+        steps = {
+            'nltk': self.ensure_punkt,
+            'sql': lambda: self.database.db,
+            'vectordb': lambda: self.vectordb,
+            **self.__warm_up_hooks
+        }
+
+        results = {}
+        for name, step in steps.items():
+            try:
+                step()
+                results[name] = None
+
+            except Exception as e:
+                logging.error(f'Failed to warm up {name}. error: {e}')
+                results[name] = str(e)
+
+        self.__warm = all(error is None for error in results.values())
+        logging.info(f'warm up finished. ready: {self.__warm}')
+        return results
+
+
+    def readiness(self) -> dict:
+        '''
+        Checks if the process has been warmed up and the SQL database answers.
+        '''
+        sql = False
+        if self.__database is not None:
+            try:
+                with self.database.db.connect() as conn:
+                    conn.execute(text('SELECT 1;'))
+                    sql = True
+
+            except Exception as e:
+                logging.error(f'Readiness check failed for sql. error: {e}')
+
+        resources = {'nltk': self.__punkt_ready, 'sql': sql, 'vectordb': self.__vectordb is not None}
+        return {'ready': self.__warm and all(resources.values()), 'resources': resources}
+
+
+registry = ResourceRegistry()
@@ -0,0 +1,89 @@
+import logging
+from fastapi import HTTPException, status
+from util.util import read_configs, normalize_query
+from util.modelparams import RetrievalParams
+from util.cache import LRUCache, corpus_versions
+from util.resources import registry
+from util.lexical import bm25_search, fuse_results
+
+
+logging.basicConfig(level=logging.INFO)
+CACHE_CONFIGS = read_configs(filename='config.json')['cache']
+RETRIEVAL_CONFIGS = read_configs(filename='config.json')['retrieval']
+
+# (userid, corpus version, normalized query, top_k, threshold, doc_ids) -> excerpts
+retrieval_cache = LRUCache('retrieval', CACHE_CONFIGS['retrieval']['size'], ttl=CACHE_CONFIGS['retrieval']['ttl'])
+
+
+def resolve_retrieval(top_k=None, threshold=None, doc_ids=None) -> RetrievalParams:
+    '''
+    Fills in the configured defaults for the retrieval options of a query and validates them.
+    '''
+    top_k = RETRIEVAL_CONFIGS['top_k'] if top_k is None else top_k
+    threshold = registry.vectordb.threshold if threshold is None else threshold
+
+    if top_k < 1 or top_k > RETRIEVAL_CONFIGS['max_top_k']:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Invalid top_k. Must be 1-{RETRIEVAL_CONFIGS["max_top_k"]}.'
+            )
+
+    if threshold <= 0 or threshold > RETRIEVAL_CONFIGS['max_threshold']:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Invalid threshold. Must be greater than 0 and at most {RETRIEVAL_CONFIGS["max_threshold"]}.'
+            )
+
+    if doc_ids is not None and len(doc_ids) > RETRIEVAL_CONFIGS['max_doc_ids']:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Too many doc_ids. At most {RETRIEVAL_CONFIGS["max_doc_ids"]} documents can be searched at once.'
+            )
+
+    doc_ids = sorted(set(doc_ids)) if doc_ids else None
+    return RetrievalParams(top_k=top_k, threshold=threshold, doc_ids=doc_ids)
+
+
+def query_excerpts(query: str, userid: int, params=None) -> list:
+    '''
+    Finds the excerpts of the user's documents relevant to the query, serving repeats from
+    the retrieval cache until the user's documents change.
+    The returned list is shared with the cache and must not be modified.
+    '''
+    params = params if params else resolve_retrieval()
+    doc_ids = tuple(params.doc_ids) if params.doc_ids else None
+
+    # read the version first so results racing with an upload are cached under the old version
+    key = (userid, corpus_versions.get(userid), normalize_query(query), params.top_k, params.threshold, doc_ids)
+    excerpts = retrieval_cache.get(key)
+    if excerpts is not None:
+        return excerpts
+
+    excerpts = search_excerpts(query, userid, params)
+    retrieval_cache.set(key, excerpts)
+    return excerpts
+
+
+def search_excerpts(query: str, userid: int, params: RetrievalParams) -> list:
+    '''
+    Runs the vector search and, with retrieval.hybrid, a BM25 search over the lexical index
+    and fuses both rankings, so exact identifiers missed by the embeddings are still found.
+    The threshold applies to the vector results, BM25 hits have no distance and are only kept
+    on their own above retrieval.min_lexical_score. Nothing is returned if neither passes.
+    '''
+    vectordb = registry.vectordb
+    if not RETRIEVAL_CONFIGS['hybrid']:
+        return vectordb.query(query, userid, n_results=params.top_k, threshold=params.threshold, doc_ids=params.doc_ids)
+
+    candidates = max(RETRIEVAL_CONFIGS['candidates'], params.top_k)
+    vector_results = vectordb.query(query, userid, n_results=candidates, threshold=params.threshold, doc_ids=params.doc_ids)
+
+    try:
+        lexical_results = bm25_search(query, userid, candidates, params.doc_ids)
+
+    except Exception as e:
+        # the lexical index is an improvement on top of the vector search, never a reason to fail
+        logging.error(f'BM25 search failed for user {userid}. error: {e}')
+        lexical_results = []
+
+    return fuse_results(vector_results, lexical_results, params.top_k)
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+from util.metrics import metrics
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class SingleFlight():
+    '''
+    Coalesces concurrent calls with the same key into one execution whose result (or exception)
+    every caller shares. The work runs as its own task, so a caller that disconnects does not
+    cancel it for the others. Only calls in flight in the same process are coalesced.
+    Coalesced calls are counted in metrics as {name}_coalesced.
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        self.__inflight = {}
+
+
+    async def run(self, key, fn):
+        '''
+        Awaits fn() (a coroutine function without arguments), or the execution already running for key.
+        '''
+        task = self.__inflight.get(key)
+        if task is not None:
+            metrics.incr(f'{self.name}_coalesced')
+        else:
+            task = asyncio.ensure_future(fn())
+            self.__inflight[key] = task
+            task.add_done_callback(lambda t: self.__done(key, t))
+
+        return await asyncio.shield(task)
+
+
+    def __done(self, key, task):
+        if self.__inflight.get(key) is task:
+            del self.__inflight[key]
+
+        # marks the exception as retrieved in case every caller went away before it finished
+        if not task.cancelled() and task.exception() is not None:
+            logging.info(f'{self.name} call failed. error: {task.exception()}')
+
+
+    def __len__(self):
+        return len(self.__inflight)
+
+
+class Broadcast():
+    '''
+    Buffer of the items of one source iterator that any number of subscribers can follow.
+    '''
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.__changed = asyncio.Event()
+
+
+    def __notify(self):
+        # every waiter holds the current event, a fresh one is used for the next change
+        changed, self.__changed = self.__changed, asyncio.Event()
+        changed.set()
+
+
+    async def produce(self, source):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self.__notify()
+
+        except Exception as e:
+            self.error = e
+
+        finally:
+            self.done = True
+            self.__notify()
+
+
+    async def subscribe(self):
+        '''
+        Yields every item from the first one, waiting for live items once the buffer is replayed.
+        '''
+        i = 0
+        while True:
+            while i < len(self.items):
+                yield self.items[i]
+                i += 1
+
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+            await self.__changed.wait()
+
+
+class SharedStream():
+    '''
+    Shares one execution of an async iterator per key between concurrent subscribers.
+    The source runs as its own task and buffers every item, so a subscriber that joins late
+    first replays what was already produced and then follows live items, and one that
+    disconnects does not stop it for the others. A failed source raises in every subscriber.
+    Joins to a running source are counted in metrics as {name}_coalesced.
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        self.__inflight = {}
+
+
+    def subscribe(self, key, fn):
+        '''
+        Follows fn() (a function returning an async iterator), or the source already running for key.
+        '''
+        broadcast = self.__inflight.get(key)
+        if broadcast is not None:
+            metrics.incr(f'{self.name}_coalesced')
+        else:
+            broadcast = Broadcast()
+            self.__inflight[key] = broadcast
+            task = asyncio.ensure_future(broadcast.produce(fn()))
+            task.add_done_callback(lambda t: self.__done(key, broadcast))
+
+        return broadcast.subscribe()
+
+
+    def __done(self, key, broadcast):
+        if self.__inflight.get(key) is broadcast:
+            del self.__inflight[key]
+
+        if broadcast.error is not None:
+            logging.info(f'{self.name} stream failed. error: {broadcast.error}')
+
+
+    def __len__(self):
+        return len(self.__inflight)
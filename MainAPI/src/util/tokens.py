@@ -0,0 +1,22 @@
+import tiktoken
+import threading
+
+
+# tokenizer of the chat model the excerpts are sent to
+TOKEN_MODEL = 'gpt-3.5-turbo'
+
+encoding = None
+encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    global encoding
+    with encoding_lock:
+        if encoding is None:
+            encoding = tiktoken.encoding_for_model(TOKEN_MODEL)
+
+    return encoding
+
+
+def count_tokens(s: str) -> int:
+    return len(get_encoding().encode(s, disallowed_special=()))
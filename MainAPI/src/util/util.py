@@ -2,6 +2,7 @@ import json
 import logging
 import bcrypt
 import os
+import hashlib
 from fastapi import HTTPException, status
 
 
@@ -17,5 +18,16 @@ def read_configs(filename='config.json') -> dict:
     return data
 
 
+def hash_text(s: str) -> str:
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def normalize_query(s: str) -> str:
+    '''
+    Lower cases a query and collapses whitespace so trivially different repeats share cache entries.
+    '''
+    return ' '.join(s.lower().split())
+
+
 
 
@@ -0,0 +1,527 @@
+import os
+import json
+import shutil
+import fcntl
+import logging
+import threading
+import numpy as np
+from abc import ABC, abstractmethod
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class VectorBackend(ABC):
+    '''
+    Storage and search of excerpt embeddings, one collection per user.
+    Distances are squared L2 between unit vectors (2 - 2 * cosine similarity), the same
+    scale as Chroma's default space so thresholds work with every backend.
+    '''
+    @abstractmethod
+    def add(self, userid: int, ids: list, embeddings: list, documents: list, docids: list):
+        pass
+
+
+    @abstractmethod
+    def delete(self, userid: int, docids: list) -> bool:
+        '''
+        Removes every excerpt of the given documents in one call.
+        '''
+
+
+    @abstractmethod
+    def drop(self, userid: int):
+        '''
+        Removes the user's whole collection, e.g. before rebuilding it.
+        '''
+
+
+    @abstractmethod
+    def query(self, userid: int, embeddings: list, n_results: int, doc_ids=None) -> list:
+        '''
+        Returns a list per query embedding of the n_results closest excerpts
+        as {'id', 'doc_id', 'distance', 'text'}, closest first. doc_ids restricts the search to those documents.
+        '''
+
+
+class ChromaBackend(VectorBackend):
+    def __init__(self, client, embedding_function=None):
+        self.client = client
+        self.embedding_function = embedding_function
+
+
+    def add(self, userid: int, ids: list, embeddings: list, documents: list, docids: list):
+        collection = self.client.get_or_create_collection(f'user-{userid}', embedding_function=self.embedding_function)
+        collection.add(
+            documents=documents,
+            embeddings=embeddings,
+            metadatas=[{'docid': docid} for docid in docids],
+            ids=[str(i) for i in ids]
+        )
+
+
+    def delete(self, userid: int, docids: list) -> bool:
+        try:
+            collection = self.client.get_collection(f'user-{userid}')
+            collection.delete(where={'docid': {'$in': list(docids)}})
+            return True
+
+        except ValueError as e:
+            logging.info('Could not find collection. error: ' + str(e))
+            return False
+
+
+    def drop(self, userid: int):
+        try:
+            self.client.delete_collection(f'user-{userid}')
+
+        except ValueError as e:
+            logging.info('Could not find collection. error: ' + str(e))
+
+
+    def query(self, userid: int, embeddings: list, n_results: int, doc_ids=None) -> list:
+        try:
+            collection = self.client.get_collection(f'user-{userid}', embedding_function=self.embedding_function)
+
+        except ValueError as e:
+            logging.info('Could not find collection. error: ' + str(e))
+            return [[] for e in embeddings]
+
+        where = {'docid': {'$in': list(doc_ids)}} if doc_ids else None
+        excerpts = collection.query(query_embeddings=embeddings, n_results=n_results, where=where)
+        results = []
+        for ids, distances, texts, metadatas in zip(excerpts['ids'], excerpts['distances'], excerpts['documents'], excerpts['metadatas']):
+            results.append([
+                {'id': id, 'doc_id': meta['docid'], 'distance': d, 'text': text}
+                for id, d, text, meta in zip(ids, distances, texts, metadatas)
+                ])
+
+        return results
+
+
+# dtype and row width of every per row column file, 'dim' is the embedding dimension
+COLUMN_TYPES = {
+    'ids.i64': (np.int64, 1),
+    'docids.i64': (np.int64, 1),
+    'offsets.i64': (np.int64, 2),
+    'vectors.f32': (np.float32, 'dim'),
+    'vectors.f16': (np.float16, 'dim'),
+    'vectors.i8': (np.int8, 'dim'),
+    'scales.f32': (np.float32, 1)
+}
+
+QUANTIZED_COLUMNS = {
+    'none': ['vectors.f32'],
+    'float16': ['vectors.f16'],
+    'int8': ['vectors.i8', 'scales.f32']
+}
+
+
+def quantize(vectors: np.ndarray, quantization: str) -> dict:
+    '''
+    Encodes normalized float32 vectors for the scanned columns of a quantization mode.
+    int8 stores one float32 scale per vector so each row uses the full [-127, 127] range.
+    '''
+    if quantization == 'none':
+        return {'vectors.f32': vectors.astype(np.float32)}
+
+    if quantization == 'float16':
+        return {'vectors.f16': vectors.astype(np.float16)}
+
+    if quantization == 'int8':
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+        quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+        return {'vectors.i8': quantized, 'scales.f32': scales.astype(np.float32)}
+
+    raise ValueError(f'Unknown quantization: {quantization}')
+
+
+class NumpyUserIndex():
+    '''
+    Append only files holding one user's normalized embeddings, memory mapped for search:
+    one file per column (see COLUMN_TYPES) plus texts.bin (utf-8) addressed by offsets.i64.
+    ids.i64 is written last, so its length is the number of complete rows, and writers first cut
+    every other file back to it, dropping what a failed append left behind.
+    Rewrites write every file to a .tmp copy and only then replace the files, marked by a
+    'rewrite' file, so an interrupted rewrite is finished by the next writer or reader.
+    Writers hold an exclusive flock on the directory's lock file, readers a shared one
+    while (re)mapping, so several worker processes can share the files.
+
+    The quantization mode and whether a float32 copy is kept for rescoring are fixed in
+    meta.json when the index is created.
+    '''
+    def __init__(self, path: str, quantization='none', rescore=True):
+        self.path = path
+        self.quantization = quantization
+        self.rescore = rescore
+        self.__state = None
+        self.__lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+
+    def __file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+
+    def __flock(self, mode):
+        lockfile = open(self.__file('lock'), 'a')
+        fcntl.flock(lockfile, mode)
+        return lockfile
+
+
+    def __meta(self) -> dict:
+        try:
+            with open(self.__file('meta.json'), 'r') as file:
+                return json.load(file)
+
+        except FileNotFoundError:
+            return {}
+
+
+    @staticmethod
+    def columns(meta: dict) -> list:
+        '''
+        Column files of an index, in write order.
+        '''
+        columns = ['docids.i64', 'offsets.i64'] + QUANTIZED_COLUMNS[meta['quantization']]
+        if meta['quantization'] != 'none' and meta['rescore']:
+            columns.append('vectors.f32')
+
+        return columns + ['ids.i64']
+
+
+    @staticmethod
+    def row_bytes(name: str, meta: dict) -> int:
+        dtype, width = COLUMN_TYPES[name]
+        return np.dtype(dtype).itemsize * (meta['dim'] if width == 'dim' else width)
+
+
+    def __recover(self):
+        '''
+        Brings the files back to a consistent state after an interrupted write.
+        Must hold the exclusive lock.
+        '''
+        rewrite = os.path.exists(self.__file('rewrite'))
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                if rewrite:
+                    os.replace(self.__file(name), self.__file(name[:-len('.tmp')]))
+                else:
+                    os.remove(self.__file(name))
+
+        if rewrite:
+            os.remove(self.__file('rewrite'))
+
+        meta = self.__meta()
+        if not meta:
+            return
+
+        # rows complete in every column, normally the length of ids.i64 which is written last
+        columns = self.columns(meta)
+        sizes = {name: os.path.getsize(self.__file(name)) if os.path.exists(self.__file(name)) else 0 for name in columns}
+        count = min(sizes[name] // self.row_bytes(name, meta) for name in columns)
+
+        for name in columns:
+            if sizes[name] > count * self.row_bytes(name, meta):
+                os.truncate(self.__file(name), count * self.row_bytes(name, meta))
+
+        texts_end = 0
+        if count > 0:
+            start, length = self.__read('offsets.i64', count, meta)[-1]
+            texts_end = int(start + length)
+        if os.path.exists(self.__file('texts.bin')) and os.path.getsize(self.__file('texts.bin')) > texts_end:
+            os.truncate(self.__file('texts.bin'), texts_end)
+
+
+    def __map(self, name: str, count: int, meta: dict):
+        dtype, width = COLUMN_TYPES[name]
+        width = meta['dim'] if width == 'dim' else width
+        shape = (count,) if width == 1 else (count, width)
+        return np.memmap(self.__file(name), dtype=dtype, mode='r', shape=shape)
+
+
+    def __read(self, name: str, count: int, meta: dict) -> np.ndarray:
+        dtype, width = COLUMN_TYPES[name]
+        width = meta['dim'] if width == 'dim' else width
+        data = np.fromfile(self.__file(name), dtype=dtype, count=count*width)
+        return data if width == 1 else data.reshape(count, width)
+
+
+    def snapshot(self):
+        '''
+        Returns (meta, columns) with the memory mapped column arrays and texts, remapping
+        them if another writer changed the files since the last call. None if empty.
+        '''
+        try:
+            stat = os.stat(self.__file('ids.i64'))
+        except FileNotFoundError:
+            return None
+
+        version = (stat.st_ino, stat.st_size)
+        with self.__lock:
+            if self.__state is not None and self.__state[0] == version:
+                return self.__state[1]
+
+            if os.path.exists(self.__file('rewrite')):
+                with self.__flock(fcntl.LOCK_EX):
+                    self.__recover()
+
+            with self.__flock(fcntl.LOCK_SH):
+                count = os.path.getsize(self.__file('ids.i64')) // 8
+                if count == 0:
+                    self.__state = (version, None)
+                    return None
+
+                meta = self.__meta()
+                arrays = {name: self.__map(name, count, meta) for name in self.columns(meta)}
+                # a zero length file cannot be mapped, which happens if every excerpt is empty
+                texts_size = os.path.getsize(self.__file('texts.bin'))
+                arrays['texts.bin'] = np.memmap(self.__file('texts.bin'), dtype=np.uint8, mode='r') if texts_size else np.empty(0, dtype=np.uint8)
+
+            self.__state = (version, (meta, arrays))
+            return meta, arrays
+
+
+    def append(self, ids: list, vectors: np.ndarray, documents: list, docids: list):
+        '''
+        Appends rows, skipping ids that are already stored (like Chroma's add) so replaying
+        a batch, e.g. when a reindex resumes, does not duplicate excerpts.
+        '''
+        with self.__flock(fcntl.LOCK_EX):
+            self.__recover()
+            meta = self.__meta()
+            if not meta:
+                meta = {'dim': vectors.shape[1], 'quantization': self.quantization, 'rescore': self.rescore}
+                with open(self.__file('meta.json'), 'w') as file:
+                    json.dump(meta, file)
+
+            ids = np.asarray(ids, dtype=np.int64)
+            if os.path.exists(self.__file('ids.i64')):
+                new = ~np.isin(ids, np.fromfile(self.__file('ids.i64'), dtype=np.int64))
+                if not new.all():
+                    ids, vectors = ids[new], vectors[new]
+                    documents = [d for d, keep in zip(documents, new) if keep]
+                    docids = [d for d, keep in zip(docids, new) if keep]
+
+            encoded = [d.encode('utf-8') for d in documents]
+            start = os.path.getsize(self.__file('texts.bin')) if os.path.exists(self.__file('texts.bin')) else 0
+            lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+            offsets = np.stack([start + np.cumsum(lengths) - lengths, lengths], axis=1)
+
+            data = quantize(vectors, meta['quantization'])
+            data.update({
+                'vectors.f32': vectors.astype(np.float32),
+                'docids.i64': np.asarray(docids, dtype=np.int64),
+                'offsets.i64': offsets,
+                'ids.i64': ids
+            })
+
+            with open(self.__file('texts.bin'), 'ab') as file:
+                file.write(b''.join(encoded))
+
+            for name in self.columns(meta):
+                with open(self.__file(name), 'ab') as file:
+                    file.write(data[name].tobytes())
+
+
+    def remove_docs(self, removed: list) -> bool:
+        '''
+        Rewrites the files once without the rows of the documents.
+        '''
+        with self.__flock(fcntl.LOCK_EX):
+            self.__recover()
+            try:
+                count = os.path.getsize(self.__file('ids.i64')) // 8
+            except FileNotFoundError:
+                return False
+
+            if count == 0:
+                return False
+
+            meta = self.__meta()
+            docids = self.__read('docids.i64', count, meta)
+            keep = ~np.isin(docids, list(removed))
+            if keep.all():
+                return False
+
+            offsets = self.__read('offsets.i64', count, meta)
+            with open(self.__file('texts.bin'), 'rb') as file:
+                texts = file.read()
+
+            kept_texts = [texts[start: start+length] for start, length in offsets[keep]]
+            lengths = np.array([len(t) for t in kept_texts], dtype=np.int64)
+
+            data = {name: self.__read(name, count, meta)[keep] for name in self.columns(meta)}
+            data['offsets.i64'] = np.stack([np.cumsum(lengths) - lengths, lengths], axis=1)
+
+            # every .tmp file is complete before the first one replaces its file, the rewrite marker
+            # tells __recover to finish the replacing if this is interrupted
+            files = [('texts.bin', b''.join(kept_texts))] + [(name, data[name].tobytes()) for name in self.columns(meta)]
+            for name, content in files:
+                with open(self.__file(name + '.tmp'), 'wb') as file:
+                    file.write(content)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            open(self.__file('rewrite'), 'w').close()
+            for name, content in files:
+                os.replace(self.__file(name + '.tmp'), self.__file(name))
+            os.remove(self.__file('rewrite'))
+
+            return True
+
+
+    def disk_usage(self) -> dict:
+        '''
+        Bytes per file of the index, used for memory reports.
+        '''
+        return {name: os.path.getsize(self.__file(name)) for name in os.listdir(self.path) if name not in ('lock', 'rewrite')}
+
+
+class NumpyBackend(VectorBackend):
+    '''
+    In process search over per user NumPy matrices of normalized embeddings memory mapped
+    from disk. Queries are answered with one matrix product per block of rows.
+
+    With float16 or int8 quantization the scan runs on the compact vectors and, if rescore_factor
+    is set, the best rescore_factor * n_results candidates are rescored exactly with the float32
+    copy, which is only read for those rows and so stays out of memory otherwise.
+    '''
+    def __init__(self, path: str, block_rows=65536, quantization='none', rescore_factor=4):
+        self.path = path
+        self.block_rows = block_rows
+        self.quantization = quantization
+        self.rescore_factor = rescore_factor
+        self.__indexes = {}
+        self.__lock = threading.Lock()
+
+
+    def index(self, userid: int) -> NumpyUserIndex:
+        with self.__lock:
+            if userid not in self.__indexes:
+                self.__indexes[userid] = NumpyUserIndex(
+                    os.path.join(self.path, f'user-{userid}'), self.quantization, self.rescore_factor > 0
+                    )
+
+            return self.__indexes[userid]
+
+
+    def add(self, userid: int, ids: list, embeddings: list, documents: list, docids: list):
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        self.index(userid).append(ids, vectors, documents, docids)
+
+
+    def delete(self, userid: int, docids: list) -> bool:
+        return self.index(userid).remove_docs(docids)
+
+
+    def drop(self, userid: int):
+        with self.__lock:
+            index = self.__indexes.pop(userid, None)
+
+        path = index.path if index else os.path.join(self.path, f'user-{userid}')
+        shutil.rmtree(path, ignore_errors=True)
+
+
+    def block_similarities(self, meta: dict, arrays: dict, queries: np.ndarray, rows) -> np.ndarray:
+        '''
+        Similarities of the queries to the given rows (a slice or an index array) computed on
+        the scanned (possibly quantized) columns.
+        '''
+        if meta['quantization'] == 'int8':
+            block = np.asarray(arrays['vectors.i8'][rows], dtype=np.float32)
+            return (queries @ block.T) * np.asarray(arrays['scales.f32'][rows])
+
+        name = 'vectors.f16' if meta['quantization'] == 'float16' else 'vectors.f32'
+        return queries @ np.asarray(arrays[name][rows], dtype=np.float32).T
+
+
+    def search(self, meta: dict, arrays: dict, queries: np.ndarray, n_results: int, allowed=None):
+        '''
+        Returns (rows, similarities) of the n_results best rows per query, best first.
+        allowed is an optional sorted array of the only rows to search.
+        '''
+        count = arrays['ids.i64'].shape[0] if allowed is None else len(allowed)
+        rescore = meta['quantization'] != 'none' and meta['rescore']
+        # whether an index keeps a rescoring copy is fixed at creation, the factor is read from the
+        # current config and may since have been set to 0
+        k = min(n_results * max(self.rescore_factor, 1) if rescore else n_results, count)
+        best_rows = np.empty((queries.shape[0], 0), dtype=np.int64)
+        best_sims = np.empty((queries.shape[0], 0), dtype=np.float32)
+
+        for start in range(0, count, self.block_rows):
+            if allowed is None:
+                rows = np.arange(start, min(start + self.block_rows, count))
+                sims = self.block_similarities(meta, arrays, queries, slice(start, start + self.block_rows))
+            else:
+                rows = allowed[start: start+self.block_rows]
+                sims = self.block_similarities(meta, arrays, queries, rows)
+
+            top = np.argpartition(-sims, min(k, sims.shape[1]) - 1, axis=1)[:, :k]
+            best_rows = np.concatenate([best_rows, rows[top]], axis=1)
+            best_sims = np.concatenate([best_sims, np.take_along_axis(sims, top, axis=1)], axis=1)
+
+            if best_rows.shape[1] > k:
+                keep = np.argpartition(-best_sims, k - 1, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_sims = np.take_along_axis(best_sims, keep, axis=1)
+
+        if rescore:
+            exact = arrays['vectors.f32']
+            best_sims = np.stack([exact[np.sort(rows)] @ q for rows, q in zip(best_rows, queries)])
+            best_rows = np.sort(best_rows, axis=1)
+
+        order = np.argsort(-best_sims, axis=1)[:, :n_results]
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_sims, order, axis=1)
+
+
+    def query(self, userid: int, embeddings: list, n_results: int, doc_ids=None) -> list:
+        snapshot = self.index(userid).snapshot()
+        if snapshot is None:
+            return [[] for e in embeddings]
+
+        meta, arrays = snapshot
+        ids, docids, offsets, texts = arrays['ids.i64'], arrays['docids.i64'], arrays['offsets.i64'], arrays['texts.bin']
+
+        allowed = None
+        if doc_ids:
+            allowed = np.flatnonzero(np.isin(arrays['docids.i64'], list(doc_ids)))
+            if len(allowed) == 0:
+                return [[] for e in embeddings]
+
+        queries = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        rows, sims = self.search(meta, arrays, queries, n_results, allowed)
+
+        results = []
+        for query_rows, query_sims in zip(rows, sims):
+            excerpts = []
+            for row, sim in zip(query_rows, query_sims):
+                start, length = offsets[row]
+                text = bytes(texts[start: start+length]).decode('utf-8')
+                excerpts.append({'id': str(ids[row]), 'doc_id': int(docids[row]), 'distance': float(2 - 2 * sim), 'text': text})
+            results.append(excerpts)
+
+        return results
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def get_vector_backend(name: str, configs: dict, client=None, embedding_function=None) -> VectorBackend:
+    '''
+    Creates the backend selected by database.vector_backend.
+    '''
+    if name == 'chroma':
+        return ChromaBackend(client, embedding_function)
+
+    if name == 'numpy':
+        numpy_configs = configs['database']['numpy']
+        return NumpyBackend(
+            numpy_configs['path'],
+            quantization=numpy_configs.get('quantization', 'none'),
+            rescore_factor=numpy_configs.get('rescore_factor', 4)
+            )
+
+    raise ValueError(f'Unknown vector backend: {name}')
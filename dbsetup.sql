@@ -1,7 +1,11 @@
 USE 597Project;
 
+DROP TABLE embedding_cache;
+DROP TABLE excerpt_terms;
+DROP TABLE lexical_stats;
 DROP TABLE excerpts;
 DROP TABLE documents;
+DROP TABLE ingest_jobs;
 DROP TABLE login_sessions;
 DROP TABLE users;
 DROP TABLE invalid_jwt_tokens;
@@ -38,16 +42,78 @@ CREATE TABLE IF NOT EXISTS documents (
     upload_ts DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     title varchar(256) NOT NULL,
     descr TEXT,
+    content_hash CHAR(64),
+    chunk_strategy varchar(16),
+    chunk_size int,
+    chunk_overlap int,
+    num_chunks int,
+    avg_chunk_tokens float,
+    max_chunk_tokens int,
 
     PRIMARY KEY (doc_id),
+    INDEX (content_hash),
+    INDEX (user_id, doc_id),
     FOREIGN KEY (user_id) references users(user_id)
 );
 
 CREATE TABLE IF NOT EXISTS excerpts (
     excerpt_id int NOT NULL AUTO_INCREMENT,
     excerpt TEXT NOT NULL,
+    body TEXT,
+    excerpt_hash CHAR(64),
+    term_count int,
     doc_id int NOT NULL,
 
     PRIMARY KEY (excerpt_id),
+    INDEX (excerpt_hash),
     FOREIGN KEY (doc_id) references documents(doc_id)
+);
+
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    text_hash CHAR(64) NOT NULL,
+    model varchar(100) NOT NULL,
+    embedding BLOB NOT NULL,
+    query_only BOOLEAN NOT NULL DEFAULT FALSE,
+    created_ts DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (text_hash, model),
+    INDEX (query_only, created_ts)
+);
+
+CREATE TABLE IF NOT EXISTS excerpt_terms (
+    term varchar(64) NOT NULL,
+    excerpt_id int NOT NULL,
+    user_id int NOT NULL,
+    tf int NOT NULL,
+
+    PRIMARY KEY (user_id, term, excerpt_id),
+    INDEX (excerpt_id),
+    FOREIGN KEY (excerpt_id) references excerpts(excerpt_id),
+    FOREIGN KEY (user_id) references users(user_id)
+);
+
+CREATE TABLE IF NOT EXISTS lexical_stats (
+    user_id int NOT NULL,
+    num_excerpts int NOT NULL DEFAULT 0,
+    total_terms bigint NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (user_id),
+    FOREIGN KEY (user_id) references users(user_id)
+);
+
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    job_id CHAR(36) NOT NULL,
+    user_id int NOT NULL,
+    filename varchar(256) NOT NULL,
+    status varchar(16) NOT NULL DEFAULT 'queued',
+    stage varchar(32),
+    progress float NOT NULL DEFAULT 0,
+    doc_id int,
+    num_excerpts int,
+    error TEXT,
+    created_ts DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_ts DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (job_id),
+    FOREIGN KEY (user_id) references users(user_id)
 );
\ No newline at end of file